@@ -0,0 +1,192 @@
+import os
+import copy
+import json
+import logging
+import threading
+from pathlib import Path
+from collections import deque
+
+# Checkpoint of a category crawl, kept in <dest>/state/ so `fetch --resume` can carry on after Ctrl-C or a crash.
+# crawl_journal.jsonl is append-only, one event per line:
+#   start    the crawl parameters (category, limit, max depth, fetch path, metadata profile)
+#   page     one category page was listed: the files it returned, the subcategories it queued and its continuation
+#   handed   the next listed file was handed to the download pool
+#   done     a handed file finished downloading (or was skipped as unchanged)
+# A crawl that ran to the end is marked finished in the snapshot, and the next --resume starts a new one.
+# Every COMPACT_EVERY events the whole state is written to crawl_snapshot.json and the journal starts over, so a
+# resume replays at most that many lines. Events carry a sequence number and the snapshot the last one it holds, so
+# a crash between writing the snapshot and truncating the journal can't apply an event twice
+COMPACT_EVERY = 5000
+_lock = threading.Lock() # record_done is called from the download workers
+_state = None
+_journal = None # Open append-mode file, None when no crawl is being recorded
+_state_dir = None
+_since_compact = 0
+
+
+# Helper function for an empty crawl state
+def _new_state(params):
+    return {
+        "seq": 0,
+        "params": params,
+        "seen": set(), # Categories already queued (the crawl's cycle guard)
+        "todo": deque(), # [category, depth, continuation] still to list, in the order the crawl will list them
+        "pending": deque(), # Listed files not yet handed to the download pool, in order
+        "handed": {}, # pageid -> file info for files handed to the download pool that have not finished
+        "count": 0, # Files handed over so far (what --limit counts)
+        "finished": False,
+    }
+
+
+# Helper function to apply one journal event to a state
+def _apply(state, event):
+    op = event["op"]
+    if op == "start":
+        seq = state["seq"]
+        state.clear()
+        state.update(_new_state(event["params"]))
+        state["seq"] = seq
+        state["seen"].add(event["params"]["category"])
+        state["todo"].append([event["params"]["category"], 0, None])
+    elif op == "page":
+        category, depth, _ = state["todo"].popleft()
+        if event["next"] is not None: # The rest of this category is listed before anything else
+            state["todo"].appendleft([category, depth, event["next"]])
+        for name in event["subcats"]:
+            state["seen"].add(name)
+            state["todo"].append([name, depth + 1, None])
+        state["pending"].extend(event["files"])
+    elif op == "handed":
+        file_info = state["pending"].popleft()
+        state["handed"][str(file_info.get("pageid"))] = file_info
+        state["count"] += 1
+    elif op == "done":
+        state["handed"].pop(event["pageid"], None)
+    state["seq"] = event["seq"]
+
+
+# Helper function to read the snapshot and replay the journal after it. Returns the state, or None if there is none
+def _load(state_dir):
+    snapshot_path = state_dir / "crawl_snapshot.json"
+    journal_path = state_dir / "crawl_journal.jsonl"
+    if not snapshot_path.exists():
+        return None
+    with open(snapshot_path, encoding="utf-8") as f:
+        snapshot = json.load(f)
+    state = _new_state(snapshot["params"])
+    state.update(seq=snapshot["seq"], count=snapshot["count"], finished=snapshot["finished"], handed=snapshot["handed"],
+                 seen=set(snapshot["seen"]), todo=deque(snapshot["todo"]), pending=deque(snapshot["pending"]))
+    replayed = 0
+    if journal_path.exists():
+        with open(journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError: # Half-written last line from the crash, everything before it is intact
+                    logging.warning("Ignoring a truncated line at the end of %s", journal_path)
+                    break
+                if event["seq"] <= state["seq"]: # Already part of the snapshot
+                    continue
+                _apply(state, event)
+                replayed += 1
+    logging.info(f"Crawl state loaded from {snapshot_path} (+{replayed} journal events)")
+    return state
+
+
+# Helper function to write the whole state to the snapshot and empty the journal (call with _lock held)
+def _compact():
+    global _journal, _since_compact
+    snapshot_path = _state_dir / "crawl_snapshot.json"
+    tmp_path = snapshot_path.with_suffix(".tmp")
+    snapshot = {**_state, "seen": sorted(_state["seen"]), "todo": list(_state["todo"]), "pending": list(_state["pending"])}
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, snapshot_path) # Atomic, so there is always one complete snapshot on disk
+    if _journal is not None:
+        _journal.close()
+    _journal = open(_state_dir / "crawl_journal.jsonl", "w", encoding="utf-8")
+    _since_compact = 0
+    logging.debug("Crawl journal compacted at event %d", _state["seq"])
+
+
+# Helper function to append one event to the journal and apply it to the live state
+def _record(op, **fields):
+    global _since_compact
+    if _journal is None:
+        return
+    with _lock:
+        event = {"seq": _state["seq"] + 1, "op": op, **fields}
+        _journal.write(json.dumps(event, ensure_ascii=False) + "\n")
+        _journal.flush() # In the OS page cache at once, so it survives the process being killed
+        _apply(_state, event)
+        _since_compact += 1
+        if _since_compact >= COMPACT_EVERY:
+            _compact()
+
+
+# Function to start recording a crawl in <dest>/state/. params describe the crawl (category, limit...)
+# With resume=True the last unfinished crawl there is loaded instead, and a copy of its state is returned for
+# iter_category_members(resume=...) to carry on from. Returns None when a new crawl was started, or when there was
+# nothing to resume and params has no category to start one with (then nothing is recorded)
+def open_journal(dest, params, resume=False):
+    global _state, _state_dir, _journal, _since_compact
+    state_dir = Path(dest) / "state"
+    state_dir.mkdir(parents=True, exist_ok=True)
+    state = _load(state_dir) if resume else None
+    if resume and state is None:
+        logging.warning(f"No crawl to resume in {state_dir}, starting a new one")
+    elif state is not None and state["finished"]:
+        logging.warning(f"The last crawl of '{state['params']['category']}' already finished, starting a new one")
+        state = None
+    if state is None and not params.get("category"):
+        return None
+    with _lock:
+        _state_dir = state_dir
+        if state is None:
+            _state = _new_state(params)
+            _apply(_state, {"seq": 1, "op": "start", "params": params})
+        else:
+            _state = state
+        _compact() # Starts from a clean snapshot and an empty journal either way
+        _since_compact = 0
+    if state is None:
+        return None
+    logging.info(f"Resuming crawl of '{state['params']['category']}': {state['count']} files handed over, {len(state['handed'])} to retry, "
+                 f"{len(state['pending'])} listed, {len(state['todo'])} category pages to go")
+    with _lock:
+        return copy.deepcopy(_state)
+
+
+# Function to record one listed category page: its files, the subcategories queued from it and its continuation
+def record_page(files, subcats, continuation):
+    _record("page", files=files, subcats=subcats, next=continuation)
+
+
+# Function to record that the next listed file was handed to the download pool
+def record_handed(pageid):
+    _record("handed", pageid=str(pageid))
+
+
+# Function to record that a handed file is done with (downloaded, skipped or unchanged). Failed files are left out,
+# so a resumed crawl tries them again
+def record_done(pageid):
+    _record("done", pageid=str(pageid))
+
+
+# Function to close the journal at the end of a run. finished=True marks the crawl complete unless downloads are still
+# owed, so the next --resume starts a new crawl
+def close_journal(finished=False):
+    global _journal, _state
+    with _lock:
+        if _journal is None:
+            return
+        if finished and _state["handed"]:
+            logging.warning(f"{len(_state['handed'])} files failed to download, `fetch --resume` will try them again")
+        elif finished:
+            _state["finished"] = True
+        _compact()
+        _journal.close()
+        _journal = None
+        _state = None
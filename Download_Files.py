@@ -1,13 +1,36 @@
 import os
-import json
+import hashlib
 import logging
-import urllib.request as urq
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
-from ENV.HEADER import HEADERS
+from Http_Client import request, HTTPStatusError, call_with_retries
+from Download_Index import lookup, record_download
+from Logging_Funct import FILE
+import Metrics
+import Crawl_Journal
+from Metadata_Store import write_metadata
 from dateutil import parser
 import re
 import time
+import queue
+import threading
+from collections import Counter
+
+CHUNK_SIZE = 1024 * 1024 # Downloads are streamed to disk 1 MiB at a time instead of being held in memory
+QUEUE_DEPTH = 4 # Files waiting in the download queue per worker before the category traversal pauses
+
+# Precompiled patterns for the cleanup below and for the two formats most Commons timestamps already use
+HTML_TAGS = re.compile(r"<.*?>")
+TAKEN_ON = re.compile(r"^Taken on\s*", re.I)
+BEFORE = re.compile(r"^before\s*", re.I)
+ANNOTATIONS = re.compile(r"\(UTC\)|\(from.*\)", re.I)
+YEAR = re.compile(r"\b(\d{4})\b")
+# ISO 8601 as written by the API and most cameras: 2014-06-14, 2014-06-14 10:25, 2014-06-14T10:25:33Z, ...+02:00
+ISO_TIMESTAMP = re.compile(r"^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2}))?(?:\.\d+)?)?\s*(Z|[+-]\d{2}:?\d{2})?$")
+# EXIF DateTimeOriginal: 2014:06:14 10:25:33 (dateutil reads the colons in the date as a time)
+EXIF_TIMESTAMP = re.compile(r"^(\d{4}):(\d{2}):(\d{2})(?: (\d{2}):(\d{2}):(\d{2}))?$")
+
 
 # Function for extra robust time parsing for more robust timestamp parsing
 def parse_fallback_datetime(raw_mtime):
@@ -18,13 +41,50 @@ def parse_fallback_datetime(raw_mtime):
     if not raw_mtime:
         return None
 
+    # Fast path: plain ISO / EXIF strings need no cleanup and no fuzzy parsing
+    dt = _parse_exact(raw_mtime.strip())
+    if dt:
+        return dt
+
     # Clean HTML, non-breaking spaces, and extra text
-    raw_mtime = re.sub(r"<.*?>", "", raw_mtime)  # remove HTML tags
+    raw_mtime = HTML_TAGS.sub("", raw_mtime)  # remove HTML tags
     raw_mtime = raw_mtime.replace("\xa0", " ").strip()  # normalize spaces
-    raw_mtime = re.sub(r"^Taken on\s*", "", raw_mtime, flags=re.I)
-    raw_mtime = re.sub(r"^before\s*", "", raw_mtime, flags=re.I)
-    raw_mtime = re.sub(r"\(UTC\)|\(from.*\)", "", raw_mtime, flags=re.I).strip()
+    raw_mtime = TAKEN_ON.sub("", raw_mtime)
+    raw_mtime = BEFORE.sub("", raw_mtime)
+    raw_mtime = ANNOTATIONS.sub("", raw_mtime).strip()
+
+    dt = _parse_exact(raw_mtime) or _parse_fuzzy(raw_mtime)
+    if dt:
+        return dt
+
+    # Last resort: return current time
+    return datetime.fromtimestamp(time.time())
+
+
+# Function to parse the ISO and EXIF layouts with a single compiled regex. Returns None for anything else
+def _parse_exact(value):
+    match = ISO_TIMESTAMP.match(value) or EXIF_TIMESTAMP.match(value)
+    if not match:
+        return None
+    parts = match.groups()
+    try:
+        dt = datetime(*(int(p) if p else 0 for p in parts[:6]))
+    except ValueError: # e.g. month 00 or day 31 in a 30 day month, leave it to the fuzzy parser
+        return None
+    offset = parts[6] if len(parts) > 6 else None
+    if offset == "Z":
+        dt = dt.replace(tzinfo=timezone.utc)
+    elif offset:
+        sign = 1 if offset[0] == "+" else -1
+        digits = offset[1:].replace(":", "")
+        dt = dt.replace(tzinfo=timezone(sign * timedelta(hours=int(digits[:2]), minutes=int(digits[2:]))))
+    return dt
+
 
+# Function for the slow path: fuzzy dateutil parsing, then a bare 4-digit year
+# Memoised, because the same free-text dates ("circa 1900", "Taken on 12 March 2009") repeat across a category
+@lru_cache(maxsize=4096)
+def _parse_fuzzy(raw_mtime):
     # Try flexible parsing
     try:
         dt = parser.parse(raw_mtime, fuzzy=True)
@@ -33,79 +93,206 @@ def parse_fallback_datetime(raw_mtime):
         pass
 
     # Fallback: look for a 4-digit year
-    match = re.search(r"\b(\d{4})\b", raw_mtime)
+    match = YEAR.search(raw_mtime)
     if match:
         year = int(match.group(1))
         return datetime(year, 1, 1)  # default to Jan 1
+    return None
 
-    # Last resort: return current time
-    return datetime.fromtimestamp(time.time())
+
+# Function to convert a datetime to a UTC based ISO string (naive datetimes are taken to already be UTC)
+def to_utc_iso(dt: datetime) -> str:
+    if dt.tzinfo is None: # if no timezone, set timezone to use UTC time
+        dt = dt.replace(tzinfo=timezone.utc)
+    else:
+        dt = dt.astimezone(timezone.utc) # Even if there is a timezone, set the timezone to UTC timezone from whatever timezone it was
+    return dt.isoformat().replace("+00:00", "Z") # Return the mtime format, formatted properly
 
 
+# Function to stream a url to disk through a .part file that is renamed into place once complete
+# An existing .part file left by an interrupted run is resumed with an HTTP Range request. With expected_sha1 (what
+# imageinfo reports) the finished file is checked before the rename, so a .part left from an older version of the
+# file can't be completed with the new version's bytes
+def stream_to_file(url, filepath, expected_size=None, expected_sha1=None):
+    part_path = filepath.with_name(filepath.name + ".part")
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    if expected_size and offset > expected_size: # A .part bigger than the original can't be resumed, start over
+        logging.warning("Discarding oversized partial download %s", part_path)
+        part_path.unlink()
+        offset = 0
+    sha1 = hashlib.sha1()
+    if offset and expected_sha1: # The bytes already on disk are part of the digest too
+        with open(part_path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                sha1.update(chunk)
+    if not (expected_size and offset == expected_size): # Skips the request if the .part already holds every byte
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            logging.log(FILE, "Resuming %s from byte %d", filepath, offset)
+            Metrics.count("download_resumes")
+        started = time.perf_counter()
+        try:
+            response = request(url, headers=headers)
+        except HTTPStatusError as e:
+            if e.code != 416 or not offset: # 416 means the range starts past the end, so the .part is already complete
+                raise
+            logging.log(FILE, "Server reports %s is already complete", part_path)
+        else:
+            with response:
+                if offset and response.status != 206: # Server ignored the Range header and is sending the whole file again
+                    logging.warning("Range request for %s not honoured, restarting download", filepath)
+                    Metrics.count("download_restarts")
+                    offset = 0
+                    sha1 = hashlib.sha1()
+                with open(part_path, "ab" if offset else "wb") as f:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        sha1.update(chunk)
+            Metrics.record_latency("download", time.perf_counter() - started) # Whole transfer, first byte to last
+    final_size = part_path.stat().st_size
+    if expected_size and final_size != expected_size:
+        if final_size > expected_size: # Keep short files for a later Range resume, but drop ones that can never match
+            part_path.unlink()
+        raise IOError(f"size mismatch for {filepath.name}: expected {expected_size} bytes, got {final_size}")
+    if expected_sha1 and sha1.hexdigest() != expected_sha1: # Corrupt, or resumed across an upstream change
+        part_path.unlink()
+        Metrics.count("download_sha1_mismatches")
+        raise IOError(f"sha1 mismatch for {filepath.name}: expected {expected_sha1}, got {sha1.hexdigest()}")
+    os.replace(part_path, filepath) # Atomic rename, so filepath only ever exists once it is complete
+    return final_size
+
 
 # Function to download the files retrieved and the associated meta data
+# Returns the outcome for the file: "downloaded", "skipped", "unchanged", "failed" or "dry_run"
 def save_files_and_data(file_info, dest="PROJECT", dry_run=False):
     incoming_dir = Path(dest) / "incoming"
     incoming_dir.mkdir(parents=True, exist_ok=True)
     filename = file_info.get("title", "unknown").replace("File:", "").replace(" ", "")
     filepath = incoming_dir / filename
-    meta_path = filepath.with_suffix(filepath.suffix.lower() + ".meta.json")
     # Section below normalizes timestamps into ISO format in the JSON files
     raw_mtime = file_info.get("extmetadata", {}).get("DateTimeOriginal", {}).get("value") \
                 or file_info.get("extmetadata", {}).get("DateTimeOriginal") \
                 or file_info.get("upload_timestamp")
     iso_mtime = None
+    canonical = None
     ts = None
     # Sets the mtime for the downloaded files
     if raw_mtime:
+        started = time.perf_counter()
         mtime_dt = parse_fallback_datetime(raw_mtime)
+        Metrics.add_busy("timestamp_parse", time.perf_counter() - started)
         if mtime_dt:
             iso_mtime = mtime_dt.isoformat()
-            ts = mtime_dt.timestamp()
-            logging.info(f"parsed timestamp of {raw_mtime} for file {file_info}")
+            canonical = to_utc_iso(mtime_dt) # Stored in the sidecar so organize never has to parse the raw string again
+            ts = datetime.fromisoformat(canonical.replace("Z", "+00:00")).timestamp() # Naive times are UTC here too, like the bucket mtime
+            logging.debug("Parsed timestamp %r for %s", raw_mtime, file_info.get("title")) # The title, not the whole file_info dict
         else:
-            logging.warning(f"Could not parse timestamp '{raw_mtime}'")
+            logging.warning("Could not parse timestamp %r", raw_mtime)
 
     meta = {
         "title": file_info.get("title"),
         "pageid": file_info.get("pageid"),
         "original_url": file_info.get("url"),
+        "sha1": file_info.get("sha1"),
         "upload_timestamp": file_info.get("upload_timestamp"),
+        "canonical_timestamp": canonical,
         "extmetadata": {k: v.get("value") for k, v in file_info.get("extmetadata", {}).items()}
     }
 
+    # The download index makes re-runs incremental: same sha1 and still where the last run (or organize) left it
+    indexed = lookup(file_info.get("pageid"))
+    sha1 = file_info.get("sha1")
+    if indexed and sha1 and indexed["sha1"] == sha1 and indexed["path"] and os.path.exists(indexed["path"]):
+        logging.log(FILE, "Unchanged since last download, skipping: %s (%s)", filename, indexed["path"])
+        return "unchanged"
+
     if dry_run:
-        logging.info(f"[DRY RUN] Would download {filename}")
-        return
+        logging.log(FILE, "[DRY RUN] Would download %s", filename)
+        return "dry_run"
+
+    if indexed and sha1 and indexed["sha1"] != sha1: # The copy in incoming/ and any partial download are out of date
+        logging.log(FILE, "sha1 of %s changed upstream, downloading it again", filename)
+        filepath.unlink(missing_ok=True)
+        filepath.with_name(filepath.name + ".part").unlink(missing_ok=True)
 
     # Download the file
     if not filepath.exists() and file_info.get("url"):
+        status = "downloaded"
         try:
-            req = urq.Request(file_info["url"], headers=HEADERS)
-            with urq.urlopen(req) as response:
-                data = response.read()
-            logging.info(f"read data for {filepath} from url")
-            with open(filepath, "wb") as f:
-                f.write(data)
-            logging.info(f"Downloaded {filepath}")
+            started = time.perf_counter()
+            # Throttled or dropped transfers are retried with backoff, resuming from the .part file each time
+            size = call_with_retries(stream_to_file, file_info["url"], filepath, file_info.get("size"), sha1, what=f"Download of {filename}")
+            Metrics.add_busy("download", time.perf_counter() - started)
+            Metrics.add_files("fetch", 1, size)
+            logging.log(FILE, "Downloaded %s (%d bytes)", filepath, size)
         except Exception as e:
-            logging.error(f"Failed to download {filename}: {e}")
-            return
+            logging.error("Failed to download %s: %s", filename, e)
+            return "failed"
     else:
-        logging.info(f"Already exists, skipping: {filepath}")
+        status = "skipped"
+        logging.log(FILE, "Already exists, skipping: %s", filepath)
 
-    # Write metadata
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(meta, f, indent=2, ensure_ascii=False)
-    logging.info(f"Wrote metadata {meta_path}")
+    record_download(file_info.get("pageid"), file_info.get("title"), filename, sha1, file_info.get("size"), filepath, iso_mtime)
 
     # Set mtime
     if ts is not None:
         try:
             os.utime(filepath, (ts, ts))
-            os.utime(meta_path, (ts, ts))
-            logging.info(f"Set mtime of {filepath} and {meta_path} to {iso_mtime}")
+            logging.debug("Set mtime of %s to %s", filepath, iso_mtime)
         except Exception as e:
-            logging.warning(f"Could not set mtime for {filepath}: {e}")
+            logging.warning("Could not set mtime for %s: %s", filepath, e)
     else:
-        logging.warning(f"No valid timestamp to set mtime for {filepath}")
+        logging.warning("No valid timestamp to set mtime for %s", filepath)
+
+    # Write metadata (a .meta.json sidecar, or a record in incoming/_metadata.jsonl with --metadata-store jsonl)
+    # It is written last, so an image with its metadata next to it is a finished download (what organize --watch waits for)
+    write_metadata(filepath, meta, ts)
+    logging.debug("Wrote metadata for %s", filepath)
+    return status
+
+
+# Function to download every fetched file over a bounded pool of worker threads
+# files can be any iterable (e.g. the category generator); it is fed through a bounded queue so
+# downloads start with the first batch and memory stays flat however big the category is
+# Returns a Counter summarising how many files were downloaded, skipped or failed (plus the "total" handed in)
+def download_all(files, dest="PROJECT", dry_run=False, workers=1):
+    summary = Counter()
+    summary_lock = threading.Lock()
+    workers = max(1, workers or 1)
+    work_queue = queue.Queue(maxsize=workers * QUEUE_DEPTH) # The producer blocks once the workers fall this far behind
+
+    def worker(): # Keeps one broken file from taking the whole pool down
+        while True:
+            file_info = work_queue.get()
+            if file_info is None: # Sentinel from the producer, no more files are coming
+                return
+            try:
+                status = save_files_and_data(file_info, dest, dry_run)
+            except Exception as e:
+                logging.error("Unexpected error saving %s: %s", file_info.get("title"), e)
+                status = "failed"
+            if status != "failed": # Failed files stay owed in the crawl journal, so `fetch --resume` tries them again
+                Crawl_Journal.record_done(file_info.get("pageid"))
+            with summary_lock:
+                summary[status] += 1
+
+    logging.info(f"Downloading with {workers} worker(s)")
+    threads = [threading.Thread(target=worker, name=f"download-{n}", daemon=True) for n in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for file_info in files: # Runs the category traversal in this thread, handing files over as they arrive
+            work_queue.put(file_info)
+            summary["total"] += 1
+    finally:
+        for _ in threads:
+            work_queue.put(None)
+        for thread in threads:
+            thread.join()
+    logging.info(f"Download summary: {summary['downloaded']} succeeded, {summary['skipped']} skipped, {summary['unchanged']} unchanged, {summary['failed']} failed"
+                 + (f", {summary['dry_run']} dry run" if summary["dry_run"] else ""))
+    return summary
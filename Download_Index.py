@@ -0,0 +1,67 @@
+import os
+import time
+import logging
+from pathlib import Path
+from Sqlite_Index import SharedConnection
+
+# Persistent index of every file the pipeline has downloaded, stored in <dest>/index.sqlite.
+# Maps the Commons pageid to its title, sha1, size, current location (incoming/ or its bucket) and parsed timestamp,
+# so a re-run only downloads files that are new or whose sha1 changed upstream
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    pageid TEXT PRIMARY KEY,
+    title TEXT,
+    filename TEXT,
+    sha1 TEXT,
+    size INTEGER,
+    path TEXT,
+    timestamp TEXT,
+    updated_at REAL
+)
+"""
+_db = SharedConnection(SCHEMA) # One connection shared by every download worker
+
+
+# Function to open (or create) the index for a destination folder. Calling it again for the same folder is a no-op
+def open_index(dest):
+    index_path = Path(dest) / "index.sqlite"
+    if _db.open(index_path):
+        logging.info(f"Download index opened at {_db.path}")
+
+
+# Function to close the index at the end of a run
+def close_index():
+    _db.close()
+
+
+# Function to look up a pageid. Returns a dict of the stored columns or None if it was never downloaded
+def lookup(pageid):
+    if _db.conn is None or pageid is None:
+        return None
+    with _db.lock:
+        cursor = _db.conn.execute("SELECT pageid, title, filename, sha1, size, path, timestamp FROM files WHERE pageid = ?", (str(pageid),))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip(("pageid", "title", "filename", "sha1", "size", "path", "timestamp"), row))
+
+
+# Function to record a finished download
+def record_download(pageid, title, filename, sha1, size, path, timestamp):
+    if _db.conn is None or pageid is None:
+        return
+    with _db.lock:
+        _db.conn.execute(
+            "INSERT OR REPLACE INTO files (pageid, title, filename, sha1, size, path, timestamp, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(pageid), title, filename, sha1, size, os.path.abspath(path), timestamp, time.time()),
+        )
+        _db.conn.commit()
+
+
+# Function to point a pageid at its new location after Sort_Files placed it in a bucket
+def update_location(pageid, path):
+    if _db.conn is None or pageid is None:
+        return
+    with _db.lock:
+        _db.conn.execute("UPDATE files SET path = ?, updated_at = ? WHERE pageid = ?", (os.path.abspath(path), time.time(), str(pageid)))
+        _db.conn.commit()
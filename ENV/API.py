@@ -1 +1,4 @@
-API = "https://commons.wikimedia.org/w/api.php"
+import os
+
+# DAYBUCKETS_API points the pipeline at another MediaWiki endpoint (e.g. the local stand-in in bench/fake_commons.py)
+API = os.environ.get("DAYBUCKETS_API", "https://commons.wikimedia.org/w/api.php")
@@ -1,99 +1,217 @@
-import json
 import time
 import logging
-import urllib.request as urq
-import urllib.parse
-from Fetch_File_Info import fetch_file_info
+import threading
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from Fetch_File_Info import fetch_file_info, file_entry, imageinfo_params
+from Http_Client import get_json, call_with_retries
 from ENV.API import API
-from ENV.HEADER import HEADERS
+import Metrics
+import Crawl_Journal
 
+FETCH_PATHS = ["generator", "twostep"]
+api_calls = Counter() # API requests sent by each fetch path this run, used to compare the two
+_api_calls_lock = threading.Lock()
+
+
+# Raised when a category page can't be listed even after retries. The crawl stops there instead of going on without
+# the rest of that category and its subcategories
+class ListingError(IOError):
+    pass
+
+
+# Streams the files within the requested category (and its subcategories) one at a time, so downloads can
+# start after the first batch instead of waiting for the whole category to be listed.
+# Subcategories are walked breadth first from an explicit frontier queue (no recursion), with up to `workers`
+# categories listed at the same time. Files are always yielded in the same order, so --limit trims repeatably.
+# fetch_path "generator" gets members and their imageinfo in one query per page; "twostep" lists members and then
+# asks for their metadata 50 page IDs at a time (kept as the fallback when the generator query fails)
+# metadata_profile picks which extmetadata fields are requested (see Fetch_File_Info.METADATA_PROFILES)
+# Every listed page and every file handed out is recorded in the crawl journal when one is open (see Crawl_Journal).
+# resume is the state returned by Crawl_Journal.open_journal: the crawl then starts with the files whose download
+# never finished, then the files listed but not yet handed out, and carries on from the saved frontier
+def iter_category_members(category=None, limit=None, _seen=None, max_depth=None, workers=1, fetch_path="generator", metadata_profile="lean", resume=None):
+    if resume:
+        _seen = resume["seen"]
+        frontier = deque(tuple(entry) for entry in resume["todo"]) # (category, depth, continuation) as the last run left it
+        count = resume["count"]
+        for member in resume["handed"].values(): # Already counted towards --limit by the last run
+            yield member
+        pending = resume["pending"]
+    else:
+        if _seen is None: # Variable to prevent infinite loops
+            _seen = set()
+        if category is None: #Gracefully handles if a category is not passed in the CLI and prompts the user to enter a category
+            category = input("Enter category here: ")
+        if category in _seen:
+            logging.warning("skipping previously seen category %s to avoid infinite looping", category)
+            return
+        _seen.add(category)
+        # Categories waiting to be listed with their depth below the starting category and where to continue listing them
+        frontier = deque([(category, 0, None)])
+        count = 0
+        pending = ()
+    for member in pending:
+        if limit and count >= limit:
+            logging.warning("Limit reached, no more files will be collected")
+            return
+        Crawl_Journal.record_handed(member.get("pageid"))
+        yield member
+        count += 1
+    in_flight = deque() # (category, depth, future) for pages being listed, in the order their files must be yielded
+    workers = max(1, workers or 1)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="category")
+    try:
+        while frontier or in_flight:
+            if limit and count >= limit:
+                logging.warning("Limit reached, no more files will be collected")
+                return
+            while frontier and len(in_flight) < workers: # Lists the next few categories of the frontier ahead of time
+                name, depth, continuation = frontier.popleft()
+                in_flight.append((name, depth, pool.submit(_list_page, name, continuation, _page_limit(limit, count), fetch_path, metadata_profile)))
+            name, depth, future = in_flight.popleft()
+            try:
+                files, subcats, continuation = future.result()
+            except Exception as e: # The page stays first in the journal's frontier, so --resume starts from it
+                raise ListingError(f"Listing '{name}' failed: {e}") from e
+            if continuation: # The rest of this category comes before any other category to keep the order stable
+                in_flight.appendleft((name, depth, pool.submit(_list_page, name, continuation, _page_limit(limit, count), fetch_path, metadata_profile)))
+            queued = [] # Subcategories are queued before the files are handed out, so the journal entry for the page is complete
+            if max_depth is not None and depth >= max_depth:
+                if subcats:
+                    logging.info("Max depth %d reached at '%s', not descending into %d subcategories", max_depth, name, len(subcats))
+                subcats = []
+            for subcat in subcats:
+                subcat_name = subcat.get("title", "").replace("Category:", "")
+                if subcat_name in _seen:
+                    logging.warning("skipping previously seen category %s to avoid infinite looping", subcat_name)
+                    continue
+                _seen.add(subcat_name)
+                logging.info("Queued subcategory '%s' at depth %d", subcat_name, depth + 1)
+                frontier.append((subcat_name, depth + 1, None))
+                queued.append(subcat_name)
+            Crawl_Journal.record_page(files, queued, continuation)
+            for member in files:
+                Crawl_Journal.record_handed(member.get("pageid"))
+                yield member
+                count += 1
+                if limit and count >= limit: # Stops the traversal (and any further API requests) once the limit is reached
+                    logging.warning("Limit reached, no more files will be collected")
+                    return
+        logging.info("All files retrieved")
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True) # Drops prefetched pages nobody will read once the limit is hit
+        logging.info("API calls used: %d generator, %d two-step", api_calls["generator"], api_calls["twostep"])
 
 
 # Fetches the different files within the requested category to allow for future processing of them
 def get_all_category_members(_seen, category=None, limit=None,):
-    members = [] # Creates an empty list for the fetched files
-    cmcontinue = None
-    if _seen is None: # Variable to prevent infinite loops
-        _seen = set()
-    
+    return list(iter_category_members(category, limit, _seen))
+
+
+# Function to work out the cmlimit for the next page so the final request near --limit stays small
+def _page_limit(limit, count):
+    return min(500, max(1, limit - count)) if limit else 500
 
-    if category is None: #Gracefully handles if a category is not passed in the CLI and prompts the user to enter a category
-        category = input("Enter category here: ")
 
-    if category in _seen:
-        logging.warning(f"skipping previously seen category {category} to avoid infinite looping")
-        return members
-    _seen.add(category)
+# Lists one page of a category with the requested fetch path
+# continuation is None for the first page, a dict of continue parameters for the generator path or a cmcontinue string
+# Returns (files, subcategories, continuation for the next page or None)
+def _list_page(category, continuation, cmlimit, fetch_path="generator", metadata_profile="lean"):
+    started = time.perf_counter()
+    try:
+        if fetch_path == "generator" and not isinstance(continuation, str):
+            try:
+                return _list_page_generator(category, continuation, cmlimit, metadata_profile)
+            except Exception as e:
+                logging.warning("Generator query failed for '%s', falling back to two-step fetch: %s", category, e)
+                Metrics.count("generator_fallbacks")
+                continuation = (continuation or {}).get("gcmcontinue") # Both modules use the same continue token format
+        return _list_page_twostep(category, continuation, cmlimit, metadata_profile)
+    finally:
+        Metrics.add_busy("list_page", time.perf_counter() - started)
 
+
+# Function to count API requests per fetch path from any listing thread
+def _count_calls(fetch_path, calls):
+    with _api_calls_lock:
+        api_calls[fetch_path] += calls
+
+
+# Lists one page of a category together with the imageinfo of its files in a single query
+# (generator=categorymembers&prop=imageinfo). Follows iicontinue until the batch is complete
+def _list_page_generator(category, continuation, cmlimit, metadata_profile="lean"):
+    params = {
+        "action": "query",
+        "generator": "categorymembers",
+        "gcmtitle": f"Category:{category}",
+        "gcmlimit": cmlimit,
+        "gcmtype": "file|subcat",
+        **imageinfo_params(metadata_profile),
+        "format": "json"
+    }
+    pages = {}
+    continue_params = dict(continuation or {})
     while True:
-        params = {
-            "action": "query",
-            "list": "categorymembers",
-            "cmtitle": f"Category:{category}",
-            "cmlimit": min(500, limit - len(members)) if limit else "500",
-            "cmtype": "file|subcat",
-            "format": "json"
-        }
-        if cmcontinue:
-            params["cmcontinue"] = cmcontinue
-
-        try: # A try block to fetch the files and gracefully handle any errors with a (hopefuly) useful error code
-            query_string = urllib.parse.urlencode(params)
-            url = f"{API}?{query_string}"
-            req = urq.Request(url, headers=HEADERS)
-            # Opens the url, reads the data, and saves it to r for future use
-            with urq.urlopen(req) as response:
-                r = response.read().decode("utf-8")
-            data = json.loads(r) # Creates a JSON of the data fetched from the provided category
-        except Exception as e:
-            logging.error(f"Error fetching category members: {e}")
-            break
-        logging.info(f"Saving files in category to json")
-            
-        # Collects the data of the files within the category
-        category_members = data.get("query", {}).get("categorymembers", []) 
-        logging.debug(f"{category_members} found while fetching category members")
-        # if not category_members: 
-        #     logging.warning(f"No members found in category '{category}'") # Breaks the while loop if the category has no files
-        #     break
-        files = [m for m in category_members if m.get("ns") == 6]     # ns=6 means File
-        subcats = [m for m in category_members if m.get("ns") == 14]  # ns=14 means Category
-        if files: # Fetch files if there are any
-            page_ids = [str(f.get("pageid")) for f in files if f.get("pageid")]
-            logging.debug(f"Page IDs collected: {page_ids}")
-            fetched = fetch_file_info(page_ids)
-            members.extend(fetched)
-            logging.info(f"Fetched metadata for {len(page_ids)} files from {category}")
-        else:
-            logging.info(f"No files found in category '{category}', checking subcategories")
-
-        if limit and len(members) >= limit: # Exits if the while loop if there is a limit and the files fetched exceeds that set limit
-            logging.warning(f"Limit reached, no more files will be collected")
-            return members[:limit]
-        
-        # Process subcategories recursively
-        for subcat in subcats:
-            subcat_name = subcat.get("title", "").replace("Category:", "")
-            logging.info(f"Recursively fetching subcategory '{subcat_name}'")
-            sub_members = get_all_category_members(
-                category=subcat_name,
-                limit=limit - len(members) if limit else None,
-                _seen=_seen
-            )
-            members.extend(sub_members)
-
-            if limit and len(members) >= limit:
-                return members[:limit]
-
-
-
-        cmcontinue = data.get("continue", {}).get("cmcontinue")
-        if not cmcontinue: # Exits the while loop after every instance of continue was met and there are no more files to retrieve
-            logging.info(f"All files retrieved")
+        data = call_with_retries(get_json, API, {**params, **continue_params}, what=f"Generator query for {category!r}")
+        _count_calls("generator", 1)
+        if "error" in data:
+            raise IOError(data["error"].get("info", data["error"]))
+        for pageid, page in data.get("query", {}).get("pages", {}).items():
+            merged = pages.setdefault(pageid, page) # Later iicontinue responses repeat the page, only adding imageinfo
+            if "imageinfo" in page and "imageinfo" not in merged:
+                merged["imageinfo"] = page["imageinfo"]
+        continue_params = data.get("continue", {})
+        if "batchcomplete" in data or not continue_params: # Every page of this batch has its imageinfo
             break
+        logging.debug("Continuing imageinfo for %r with %s", category, continue_params)
+
+    files, subcats = [], []
+    for pageid, page in pages.items():
+        if page.get("ns") == 14: # ns=14 means Category
+            subcats.append(page)
+        elif page.get("ns") == 6 or "missing" in page: # ns=6 means File
+            entry = file_entry(pageid, page)
+            if entry:
+                files.append(entry)
+    logging.info("Fetched %d files with metadata from %s in one query", len(files), category)
+    return files, subcats, continue_params or None
+
 
-        
+# Lists one page of a category and hydrates its files with metadata
+# Returns (files, subcategories, cmcontinue token for the next page or None)
+def _list_page_twostep(category, cmcontinue, cmlimit, metadata_profile="lean"):
+    params = {
+        "action": "query",
+        "list": "categorymembers",
+        "cmtitle": f"Category:{category}",
+        "cmlimit": cmlimit,
+        "cmtype": "file|subcat",
+        "format": "json"
+    }
+    if cmcontinue:
+        params["cmcontinue"] = cmcontinue
 
+    # Sends the query over the shared keep-alive client (which also applies the global rate limit), retrying
+    # throttled or failed pages with backoff so a busy API doesn't cut the category short. A page that still fails is
+    # raised, never taken as the end of the category
+    data = call_with_retries(get_json, API, params, what=f"Listing {category!r}")
+    _count_calls("twostep", 1)
+    if "error" in data:
+        raise IOError(data["error"].get("info", data["error"]))
+    logging.debug("Saving files in category to json")
 
-        time.sleep(0.1) # Break to not overload the API with requests too quickly
-    return members[:limit] if limit else members
\ No newline at end of file
+    # Collects the data of the files within the category
+    category_members = data.get("query", {}).get("categorymembers", [])
+    logging.debug("%d category members found in %r", len(category_members), category) # Not the member list itself
+    files = [m for m in category_members if m.get("ns") == 6]     # ns=6 means File
+    subcats = [m for m in category_members if m.get("ns") == 14]  # ns=14 means Category
+    fetched = []
+    if files: # Fetch files if there are any
+        page_ids = [str(f.get("pageid")) for f in files if f.get("pageid")]
+        logging.debug("%d page IDs collected", len(page_ids))
+        fetched = fetch_file_info(page_ids, metadata_profile, count_request=lambda calls: _count_calls("twostep", calls))
+        logging.info("Fetched metadata for %d files from %s", len(page_ids), category)
+    else:
+        logging.info("No files found in category '%s', checking subcategories", category)
+    return fetched, subcats, data.get("continue", {}).get("cmcontinue")
@@ -1,76 +1,160 @@
-import json
+import sys
+import time
+import heapq
 import logging
-import urllib.request as urq
-import urllib.parse
+import Http_Client
+import Metrics
+import Response_Cache
+from Http_Client import get_json, is_retryable, MAX_ATTEMPTS
+from Rate_Limiter import backoff_delay
 from ENV.API import API
-from ENV.HEADER import HEADERS
 
+IIPROP = "timestamp|user|url|size|sha1|extmetadata|mediatype" # imageinfo properties collected for every file
+# extmetadata fields asked for by each metadata profile. "lean" keeps the capture date the pipeline sorts on plus the
+# attribution fields written to .meta.json; "full" (None) lets the server send every license, description and HTML blob
+METADATA_PROFILES = {
+    "lean": "DateTimeOriginal|Artist|LicenseShortName",
+    "full": None,
+}
 
 
-# Function to batch the page IDs into sets of max size 50 page IDs
-def fetch_file_info(page_ids):
-    files = []
+# Function to build the imageinfo part of a query for the chosen metadata profile
+def imageinfo_params(metadata_profile="lean"):
+    params = {"prop": "imageinfo", "iiprop": IIPROP}
+    fields = METADATA_PROFILES[metadata_profile]
+    if fields:
+        params["iiextmetadatafilter"] = fields
+    return params
 
-    # Batch page_ids into chunks of 50
-    chunk_size = 50
-    for i in range(0, len(page_ids), chunk_size):
-        batch = page_ids[i:i + chunk_size]
-        files.extend(fetch_file_info_batch(batch))  # Call the single-batch fetch function
 
-    return files
+
+# Function to batch the page IDs into sets of max size 50 page IDs
+# A batch that fails with a retryable error (429, 5xx, maxlag, dropped connection) goes on a retry queue with a jittered
+# exponential backoff while the other batches carry on. Only a batch that keeps failing MAX_ATTEMPTS times (or fails
+# with an error retrying can't fix) is given up on, and that is logged with the page IDs it held
+# count_request(n) is called with 1 for every request actually sent (cached pages need none)
+def fetch_file_info(page_ids, metadata_profile="lean", count_request=None):
+    chunk_size = 50
+    results = {} # batch number -> files, so the output keeps the order of page_ids whatever order the retries finish in
+    retry_queue = [] # heap of (due time, batch number, attempt, batch)
+    for number, i in enumerate(range(0, len(page_ids), chunk_size)):
+        retry_queue.append((0.0, number, 0, page_ids[i:i + chunk_size]))
+    heapq.heapify(retry_queue)
+    while retry_queue:
+        due, number, attempt, batch = heapq.heappop(retry_queue)
+        wait = due - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            results[number] = fetch_file_info_batch(batch, metadata_profile, count_request)
+        except Exception as e:
+            if is_retryable(e) and attempt + 1 < MAX_ATTEMPTS:
+                delay = backoff_delay(attempt, getattr(e, "retry_after", None))
+                logging.warning("Metadata batch of %d page IDs failed (%s), retry %d/%d in %.1fs", len(batch), e, attempt + 1, MAX_ATTEMPTS - 1, delay)
+                Metrics.count("metadata_batch_retries")
+                heapq.heappush(retry_queue, (time.monotonic() + delay, number, attempt + 1, batch))
+                continue
+            logging.error("Giving up on metadata for %d page IDs after %d attempts (%s): %s", len(batch), attempt + 1, e, "|".join(batch))
+            Metrics.count("metadata_batches_failed")
+            results[number] = []
+    return [entry for number in sorted(results) for entry in results[number]]
 
 
 # function to fetch info for the batches of page IDs
-def fetch_file_info_batch(page_ids):
-    logging.debug(f"the list of pageID's to fetch is {page_ids}")
+# Pages in the imageinfo cache are taken from it, and only the others are asked for (then cached)
+# Raises on request errors, fetch_file_info decides whether the batch is retried
+def fetch_file_info_batch(page_ids, metadata_profile="lean", count_request=None):
+    logging.debug("Fetching metadata for %d page IDs", len(page_ids))
     if not page_ids:
         logging.warning(f"No page ids to collect metadata from")
         return [] # Returns an empty list if no valid page_ids are provided (I.E. if a category was empty)
-    
-    pageids_str = "|".join(page_ids) #creates a string of all the page ID's seperated by | to fetch from the API
-
-    # Parameters of meta data to collect and store about each file 
-    params = {
-        "action": "query",
-        "pageids": "|".join(page_ids),
-        "prop": "imageinfo",
-        "iiprop": "timestamp|user|url|size|extmetadata|mediatype",
-        "format": "json"
-    }
 
-    try:
-        query_string = "&".join(f"{k}={urllib.parse.quote(str(v))}" for k, v in params.items())
-        url = f"{API}?{query_string}"
-        req = urq.Request(url, headers=HEADERS)
-        #logging.debug(f"the query string is {query_string} \n the url to fetch from is {url} \n req is {req}")
-            # Code above builds the query string with the parameters, and API, and headers so the request follows the wikimedia bot rules
-        with urq.urlopen(req) as response: # Opens the url and attempts and then reads the data and saves it in the data variable
-            r = response.read().decode("utf-8")
-        data = json.loads(r)
-        logging.info(f"metadata was collected")
-    except Exception as e:
-        # Logs the error if an error occurs and then returns an empty list so the entire program does not crash
-        logging.error(f"Error fetching file info: {e}") 
-        return []
+    keys = {pageid: Response_Cache.cache_key(API, {"pageids": pageid, **imageinfo_params(metadata_profile)}) for pageid in page_ids}
+    pages = {}
+    for pageid in page_ids:
+        page = Response_Cache.lookup(keys[pageid])
+        if page is not None:
+            pages[pageid] = page
+    if len(pages) < len(page_ids):
+        # Parameters of meta data to collect and store about each file
+        params = {
+            "action": "query",
+            "pageids": "|".join(pageid for pageid in page_ids if pageid not in pages),
+            **imageinfo_params(metadata_profile),
+            "format": "json"
+        }
+        started = time.perf_counter()
+        try:
+            # The shared client builds the query string and applies the headers so the request follows the wikimedia bot rules
+            data = get_json(API, params)
+            logging.debug("metadata was collected")
+        finally:
+            Metrics.add_busy("metadata_batch", time.perf_counter() - started)
+        if count_request:
+            count_request(1)
+        if "error" in data:
+            raise IOError(data["error"].get("info", data["error"]))
+        for pageid, page in data.get("query", {}).get("pages", {}).items():
+            pages[pageid] = page
+            if "imageinfo" in page and pageid in keys: # Missing pages aren't cached, they may be created later
+                Response_Cache.store(keys[pageid], page)
 
     files = [] # Creates an empty list to add the metadata from files to
     # Finds the data for each pageid given from previous fucntions and adds the metadata to the files list
-    #logging.debug(json.dumps(data, indent=2))
-    for pageid, page in data.get("query", {}).get("pages", {}).items():
-        if "missing" in page:
-            logging.warning(f"Page {pageid} is missing")
-            continue
-        info = page.get("imageinfo")
-        if not info:
-            logging.warning(f"Page {pageid} has no imageinfo (probably not a file)")
+    for pageid in page_ids:
+        page = pages.get(pageid)
+        if page is None:
             continue
-        info = info[0]
-        files.append({
-            "pageid": pageid,
-            "title": page.get("title"),
-            "url": info.get("url"),
-            "upload_timestamp": info.get("timestamp"),
-            "extmetadata": info.get("extmetadata", {}),
-        })
-        logging.info(f"Metadata for {pageid} collected and stored")
-    return files
\ No newline at end of file
+        entry = file_entry(pageid, page)
+        if entry:
+            files.append(entry)
+            logging.debug("Metadata for %s collected and stored", pageid)
+    return files
+
+
+# Function to turn one page of an imageinfo query into the file dictionary used by the rest of the pipeline
+# Returns None (and logs why) for missing pages and pages without imageinfo
+def file_entry(pageid, page):
+    if "missing" in page:
+        logging.warning("Page %s is missing", pageid)
+        return None
+    info = page.get("imageinfo")
+    if not info:
+        logging.warning("Page %s has no imageinfo (probably not a file)", pageid)
+        return None
+    info = info[0]
+    return {
+        "pageid": pageid,
+        "title": page.get("title"),
+        "url": info.get("url"),
+        "size": info.get("size"),
+        "sha1": info.get("sha1"),
+        "upload_timestamp": info.get("timestamp"),
+        "extmetadata": info.get("extmetadata", {}),
+    }
+
+
+# Function to fetch the same batch of page IDs with every metadata profile and log the bytes and time each one costs
+def compare_metadata_profiles(page_ids):
+    results = {}
+    for metadata_profile in METADATA_PROFILES:
+        bytes_before = Http_Client.stats["bytes"]
+        started = time.perf_counter()
+        files = fetch_file_info(page_ids, metadata_profile)
+        results[metadata_profile] = {
+            "files": len(files),
+            "bytes": Http_Client.stats["bytes"] - bytes_before,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        logging.info(f"{metadata_profile} profile: {results[metadata_profile]}")
+    return results
+
+
+# Only used for measuring the metadata profiles against the live API. Not used in the production code.
+if __name__ == "__main__":
+    from Fetch_Category_Members import iter_category_members
+    logging.basicConfig(level=logging.WARNING)
+    category = sys.argv[1] if len(sys.argv) > 1 else "Dogs"
+    sample = [str(f["pageid"]) for f in iter_category_members(category, limit=200, fetch_path="twostep")]
+    for name, result in compare_metadata_profiles(sample).items():
+        print(f"{name:>5}: {result['files']} files, {result['bytes']} bytes on the wire, {result['seconds']}s")
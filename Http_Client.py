@@ -0,0 +1,232 @@
+import gzip
+import json
+import time
+import logging
+import threading
+import http.client
+import urllib.parse
+from email.utils import parsedate_to_datetime
+from ENV.HEADER import HEADERS
+import Rate_Limiter
+from Rate_Limiter import acquire, release, backoff, backoff_delay
+import Metrics
+
+TIMEOUT = 60 # Seconds to wait on a connect or read before giving up on a request
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+RETRY_CODES = (429, 500, 502, 503, 504) # Throttled or a temporary server problem, worth another try later
+MAX_ATTEMPTS = 5 # Tries (the first one included) before call_with_retries gives up
+
+# http.client connections are not thread safe, so each worker thread keeps its own persistent
+# connection per (scheme, host, port). Consecutive requests to the same host reuse the open socket
+# instead of paying for a new TCP and TLS handshake every time
+_local = threading.local()
+_stats_lock = threading.Lock()
+stats = {"requests": 0, "bytes": 0, "seconds": 0.0, "hosts": {}} # Totals for every request sent this run
+
+
+# Error raised for any response with a 4xx or 5xx status code
+# retry_after holds the server's Retry-After delay in seconds, when it sent one
+class HTTPStatusError(IOError):
+    def __init__(self, url, code, reason, retry_after=None):
+        super().__init__(f"HTTP Error {code}: {reason} ({url})")
+        self.url = url
+        self.code = code
+        self.retry_after = retry_after
+
+
+# Error raised when the API refuses a query because its database replicas lag more than the maxlag we sent
+class MaxLagError(IOError):
+    def __init__(self, info, retry_after):
+        super().__init__(f"API maxlag: {info}")
+        self.retry_after = retry_after
+
+
+# Wrapper around a raw response that counts the bytes read and records the request once it is closed
+class Response:
+    def __init__(self, raw, key, url, started):
+        self.raw = raw
+        self.key = key
+        self.url = url
+        self.status = raw.status
+        self.headers = raw.headers
+        self.bytes_read = 0
+        self._started = started
+        self._closed = False
+        self.throttled = False # Set for answers that should slow the limiter down (429, 5xx, maxlag)
+
+    def read(self, amt=None):
+        data = self.raw.read(amt)
+        self.bytes_read += len(data)
+        if amt and not data and self.raw.length: # read(amt) returns short at EOF instead of raising like read() does
+            _drop_connection(self.key)
+            raise http.client.IncompleteRead(b"", self.raw.length) # Retryable, so a download resumes from its .part
+        return data
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if not self.raw.isclosed(): # Unread data would corrupt the next request on this socket, so drop the connection
+            _drop_connection(self.key)
+        _record(self.key[1], self.bytes_read, time.monotonic() - self._started)
+        release(self.throttled) # Hands the limiter slot taken in request() back
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Function to add one finished request to the run statistics
+def _record(host, num_bytes, seconds):
+    with _stats_lock:
+        stats["requests"] += 1
+        stats["bytes"] += num_bytes
+        stats["seconds"] += seconds
+        host_stats = stats["hosts"].setdefault(host, {"requests": 0, "bytes": 0, "seconds": 0.0})
+        host_stats["requests"] += 1
+        host_stats["bytes"] += num_bytes
+        host_stats["seconds"] += seconds
+    logging.debug("%s request finished in %.1fms, %d bytes", host, seconds * 1000, num_bytes)
+
+
+# Function to get (or open) this thread's persistent connection to a host
+def _get_connection(key):
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = _local.pool = {}
+    conn = pool.get(key)
+    if conn is None:
+        scheme, host, port = key
+        conn_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        conn = pool[key] = conn_class(host, port, timeout=TIMEOUT)
+    return conn
+
+
+# Function to read a Retry-After header (delay in seconds or an HTTP date) as seconds from now, None if absent or invalid
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Function to tell whether a failed request is worth retrying: throttling, 5xx, maxlag or a dropped connection
+def is_retryable(error):
+    if isinstance(error, HTTPStatusError):
+        return error.code in RETRY_CODES
+    return isinstance(error, (MaxLagError, ConnectionError, TimeoutError, http.client.HTTPException))
+
+
+# Function to call func(*args, **kwargs) until it succeeds, sleeping a jittered exponential backoff after each
+# retryable failure. Other errors, and the last failure once MAX_ATTEMPTS is reached, are raised to the caller
+def call_with_retries(func, *args, what="request", **kwargs):
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e) or attempt + 1 == MAX_ATTEMPTS:
+                raise
+            delay = backoff_delay(attempt, getattr(e, "retry_after", None))
+            logging.warning("%s failed (%s), retry %d/%d in %.1fs", what, e, attempt + 1, MAX_ATTEMPTS - 1, delay)
+            Metrics.count("retries")
+            time.sleep(delay)
+
+
+# Function to close and forget a connection that can no longer be reused
+def _drop_connection(key):
+    conn = getattr(_local, "pool", {}).pop(key, None)
+    if conn is not None:
+        conn.close()
+
+
+# Function to send a GET request over the pooled connections, following redirects
+# Returns an open Response that must be read and closed (use it as a context manager)
+def request(url, headers=None, accept_gzip=False):
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        path = parts.path or "/"
+        if parts.query:
+            path += f"?{parts.query}"
+        send_headers = dict(HEADERS) # The Wikimedia User-Agent is applied to every request here
+        if accept_gzip:
+            send_headers["Accept-Encoding"] = "gzip"
+        if headers:
+            send_headers.update(headers)
+        acquire() # Every request (API or download, any thread) shares the global limiter; the Response releases it
+        started = time.monotonic()
+        for attempt in range(2): # A kept-alive socket may have been closed by the server, so retry once on a fresh one
+            conn = _get_connection(key)
+            reused = conn.sock is not None
+            try:
+                conn.request("GET", path, headers=send_headers)
+                raw = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                _drop_connection(key)
+                if not reused or attempt:
+                    release(throttled=True)
+                    raise
+                logging.debug("Stale connection to %s, reconnecting", parts.hostname)
+                Metrics.count("http_reconnects")
+            except Exception:
+                _drop_connection(key)
+                release(throttled=True)
+                raise
+        response = Response(raw, key, url, started)
+        if raw.status in REDIRECT_CODES and raw.headers.get("Location"):
+            response.read()
+            response.close()
+            url = urllib.parse.urljoin(url, raw.headers["Location"])
+            continue
+        if raw.status >= 400:
+            retry_after = parse_retry_after(raw.headers.get("Retry-After"))
+            response.throttled = raw.status in RETRY_CODES
+            response.read()
+            response.close()
+            if raw.status == 429 or retry_after is not None and response.throttled:
+                backoff(retry_after if retry_after is not None else Rate_Limiter.BACKOFF_BASE)
+            raise HTTPStatusError(url, raw.status, raw.reason, retry_after)
+        return response
+    raise HTTPStatusError(url, 310, "Too many redirects")
+
+
+# Function to send a GET request with query parameters and decode the (possibly gzipped) JSON body
+# Every query carries maxlag, so the API turns us away while its replicas are lagging; that answer raises MaxLagError
+# after pausing the limiter for the Retry-After the API asked for
+def get_json(url, params):
+    full_url = f"{url}?{urllib.parse.urlencode({**params, 'maxlag': Rate_Limiter.MAXLAG})}"
+    started = time.perf_counter()
+    with request(full_url, accept_gzip=True) as response:
+        body = response.read()
+        Metrics.record_latency("api", time.perf_counter() - started)
+        if response.headers.get("Content-Encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        data = json.loads(body.decode("utf-8"))
+        error = data.get("error")
+        if isinstance(error, dict) and error.get("code") == "maxlag":
+            response.throttled = True
+    if isinstance(error, dict) and error.get("code") == "maxlag":
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is None:
+            retry_after = float(error.get("lag") or Rate_Limiter.MAXLAG)
+        backoff(retry_after)
+        raise MaxLagError(error.get("info", "replication lag too high"), retry_after)
+    return data
+
+
+# Function to log a summary of every request sent, per host, for the run
+def log_stats():
+    with _stats_lock:
+        for host, host_stats in stats["hosts"].items():
+            avg_ms = host_stats["seconds"] / host_stats["requests"] * 1000 if host_stats["requests"] else 0
+            logging.info(f"{host}: {host_stats['requests']} requests, {host_stats['bytes']} bytes, avg latency {avg_ms:.1f}ms")
@@ -1,19 +1,77 @@
 import os
+import copy
+import json
+import queue
+import atexit
 import logging
 from pathlib import Path
-from logging.handlers import TimedRotatingFileHandler as trfh
+from logging.handlers import TimedRotatingFileHandler as trfh, QueueHandler, QueueListener
 import time
 
+# Level for the one-line-per-file messages (downloaded, moved, skipped...). It sits between DEBUG and INFO, so a normal
+# run only logs stage summaries and --log-files adds the per-file lines without the full debug output
+FILE = 15
+logging.addLevelName(FILE, "FILE")
+LOG_FORMATS = ["text", "json"]
+_listener = None # Background thread that writes queued records to the log file and console
+
 
 # A function to convert a timestamp to UTC time
 def utc_time_conversion(*args):
     return time.gmtime(*args)
 
 
+# Formatter for --log-format json: one JSON object per line, so logs can be ingested without regex parsing
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", utc_time_conversion(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "thread": record.threadName,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Queue handler that keeps the traceback as exc_text. The stock prepare() folds it into the message and clears it, so
+# the JSON formatter could never emit a separate "exception" field
+class TracebackQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None # Tracebacks can't be pickled or safely shared across threads, the text is enough
+        return record
+
+
+# A function to stop the background log writer, flushing everything still queued. Safe to call more than once
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
 # A function to set up the logging
+# Every thread only puts records on a queue; one listener thread formats them and writes the file (and console), so
+# workers never wait on log file I/O. Messages use lazy %-style arguments, formatted only if the level is enabled
 def setup_logging(args,):
+    global _listener
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG if args.debug else logging.INFO) 
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    elif getattr(args, "log_files", False):
+        logger.setLevel(FILE)
+    else:
+        logger.setLevel(logging.INFO)
     folder = f"PROJECT/logs/"
     if args.dest is None:
         args.dest = os.path.join(os.getcwd(), folder)
@@ -21,7 +79,8 @@ def setup_logging(args,):
     log_dir.mkdir(parents=True, exist_ok=True)
     logfile = log_dir / "daybuckets.log"
 
-    # Clear any old handlers to prevent duplicates if setup_logging is called again
+    # Clear any old handlers (and the old writer thread) to prevent duplicates if setup_logging is called again
+    stop_logging()
     logger.handlers.clear()
 
 # Rotate the log file every day and only keep 7 days worth of log files
@@ -33,18 +92,29 @@ def setup_logging(args,):
         encoding="utf-8",
     )
 
-    formatter = logging.Formatter( # The format of the logged messages
-        fmt="%(asctime)s [%(levelname)s] %(message)s",
-        datefmt = "%Y-%m-%dT%H:%M:%SZ" # ISO style timestamp for each log entry
-    )
-    formatter.converter = utc_time_conversion
+    if getattr(args, "log_format", "text") == "json":
+        formatter = JsonLineFormatter()
+    else:
+        formatter = logging.Formatter( # The format of the logged messages
+            fmt="%(asctime)s [%(levelname)s] %(message)s",
+            datefmt = "%Y-%m-%dT%H:%M:%SZ" # ISO style timestamp for each log entry
+        )
+        formatter.converter = utc_time_conversion
     timed_handler.setFormatter(formatter)
-    logger.addHandler(timed_handler)
-    logger.info(f"Logging to {logfile}") # Creates a logging message saying the logging is being sent to the log file
+    handlers = [timed_handler]
     if args.verbose: # Makes the verbose CLI modifier also print the logging messages to the terminal
         console_handler = logging.StreamHandler()
         console_formatter = logging.Formatter('%(levelname)s: %(message)s')
         console_handler.setFormatter(console_formatter)
-        logger.addHandler(console_handler)
-        logger.info(f"Logs print to terminal as well as logfile with --verbose passed in CLI")
-    return logfile
\ No newline at end of file
+        handlers.append(console_handler)
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(TracebackQueueHandler(log_queue))
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    logger.info("Logging to %s", logfile) # Creates a logging message saying the logging is being sent to the log file
+    if args.verbose:
+        logger.info("Logs print to terminal as well as logfile with --verbose passed in CLI")
+    return logfile
+
+
+atexit.register(stop_logging) # Flushes whatever is still queued when the program exits
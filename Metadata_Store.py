@@ -0,0 +1,140 @@
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+try: # Serialises appends and compaction across processes (a fetch and organize --watch), not available on Windows
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Where each downloaded file's metadata is kept. Two backends, picked with `fetch --metadata-store`:
+# - "sidecar" (the original format): a pretty-printed <image>.meta.json next to every image
+# - "jsonl": one _metadata.jsonl per folder (incoming/ and every day bucket), one JSON record per line keyed by file
+#   name. Appends only; the last record for a name wins and {"filename", "deleted": true} removes it. compact()
+#   rewrites a store with its live records. It saves an inode, a rename and a utime per asset
+# Every append opens the store by path and takes an flock, so a store compacted (replaced) by another process is never
+# written through a stale handle, and no file stays open per day bucket
+# organize and the lookup functions below read both, so a tree can hold a mix of the two
+STORE_FORMATS = ["sidecar", "jsonl"]
+STORE_NAME = "_metadata.jsonl"
+_store_format = "sidecar"
+_lock = threading.Lock() # Download workers append to the same incoming/ store
+
+
+# Function to choose the backend new metadata is written with
+def configure_store(store_format="sidecar"):
+    global _store_format
+    if store_format not in STORE_FORMATS:
+        raise ValueError(f"Unknown metadata store {store_format!r}, expected one of {STORE_FORMATS}")
+    _store_format = store_format
+    logging.info(f"Metadata is written as {'.meta.json sidecars' if store_format == 'sidecar' else STORE_NAME + ' per folder'}")
+
+
+# Function to get the sidecar path of a file (name.jpg -> name.jpg.meta.json, extension lowercased)
+def sidecar_path(filepath):
+    filepath = Path(filepath)
+    return filepath.with_suffix(filepath.suffix.lower() + ".meta.json")
+
+
+# Function to write the metadata of a freshly downloaded file with the configured backend
+# mtime (a timestamp) is given to the sidecar too. Returns the sidecar path it wrote, or None when the record went to
+# the folder's store
+def write_metadata(filepath, meta, mtime=None):
+    filepath = Path(filepath)
+    if _store_format == "sidecar":
+        meta_path = sidecar_path(filepath)
+        tmp_path = meta_path.with_name(meta_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2, ensure_ascii=False)
+        if mtime is not None:
+            os.utime(tmp_path, (mtime, mtime))
+        os.replace(tmp_path, meta_path) # Atomic, so organize (or --watch) never reads a half-written sidecar
+        return meta_path
+    append_record(filepath.parent, filepath.name, meta)
+    return None
+
+
+# Helper function to append one line to a folder's store. Retries when compact() replaced the file between the open
+# and the lock, so the line never lands in an unlinked copy
+def _append(folder, line):
+    path = os.path.join(folder, STORE_NAME)
+    with _lock:
+        while True:
+            with open(path, "a", encoding="utf-8") as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                    try:
+                        if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+                            continue
+                    except FileNotFoundError: # Compacted away because it was empty
+                        continue
+                f.write(line)
+                return
+
+
+# Function to add (or replace) the record of one file in a folder's store
+def append_record(folder, filename, meta):
+    _append(folder, json.dumps({"filename": filename, "meta": meta}, ensure_ascii=False) + "\n")
+
+
+# Function to drop the record of one file from a folder's store (it was moved to its bucket)
+def remove_record(folder, filename):
+    _append(folder, json.dumps({"filename": filename, "deleted": True}) + "\n")
+
+
+# Function to read a folder's store as {filename: meta}, in the order the files were first recorded
+def read_store(folder):
+    path = os.path.join(folder, STORE_NAME)
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError: # A torn last line from an interrupted run
+                logging.warning("Ignoring an unreadable line in %s", path)
+                continue
+            if record.get("deleted"):
+                records.pop(record["filename"], None)
+            else:
+                records[record["filename"]] = record["meta"]
+    return records
+
+
+# Function to iterate over (filename, meta) for every live record of a folder's store
+def iter_records(folder):
+    return iter(read_store(folder).items())
+
+
+# Function to look up the metadata of a file, from its sidecar if it has one, else from its folder's store
+# Returns the metadata dict or None
+def lookup_metadata(filepath):
+    filepath = Path(filepath)
+    meta_path = sidecar_path(filepath)
+    if meta_path.exists():
+        with open(meta_path, encoding="utf-8") as f:
+            return json.load(f)
+    return read_store(filepath.parent).get(filepath.name)
+
+
+# Function to rewrite a folder's store with only its live records (removed if none are left)
+# Holds the store's flock throughout, so appends from other threads or processes wait and then go to the new file
+def compact(folder):
+    path = os.path.join(folder, STORE_NAME)
+    if not os.path.exists(path):
+        return
+    with _lock, open(path, "a", encoding="utf-8") as locked:
+        if fcntl is not None:
+            fcntl.flock(locked.fileno(), fcntl.LOCK_EX)
+        records = read_store(folder)
+        if not records:
+            os.remove(path)
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for filename, meta in records.items():
+                f.write(json.dumps({"filename": filename, "meta": meta}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+    logging.debug("Compacted %s to %d records", path, len(records))
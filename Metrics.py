@@ -0,0 +1,124 @@
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from collections import Counter, defaultdict
+
+# Lightweight run instrumentation shared by every module, written to <dest>/reports/metrics.json at the end of a run:
+# - stages: wall time of each pipeline stage (fetch, sort, report) with the files and bytes it handled
+# - busy: time spent inside an operation summed over every thread (listing pages, metadata batches, downloads, parsing)
+# - latency: every API / download request time, reported as percentiles
+# - counters: retries, fallbacks, cache hits and other events
+_lock = threading.Lock()
+_started = time.time()
+_stages = {} # name -> {"seconds", "files", "bytes"}
+_busy = defaultdict(lambda: [0, 0.0]) # name -> [count, seconds]
+_latencies = defaultdict(list) # kind -> [seconds]
+counters = Counter()
+
+
+# Function to clear everything recorded so far (the start of a run)
+def reset():
+    global _started
+    with _lock:
+        _started = time.time()
+        _stages.clear()
+        _busy.clear()
+        _latencies.clear()
+        counters.clear()
+
+
+# Context manager timing one stage of the run. Running the same stage twice adds up
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        with _lock:
+            entry = _stages.setdefault(name, {"seconds": 0.0, "files": 0, "bytes": 0})
+            entry["seconds"] += elapsed
+        logging.info("Stage %s took %.2fs", name, elapsed)
+
+
+# Function to credit files and bytes to a stage, for its throughput figures
+def add_files(name, files=0, num_bytes=0):
+    with _lock:
+        entry = _stages.setdefault(name, {"seconds": 0.0, "files": 0, "bytes": 0})
+        entry["files"] += files
+        entry["bytes"] += num_bytes
+
+
+# Function to add time spent inside one operation (from any thread)
+def add_busy(name, seconds, count=1):
+    with _lock:
+        entry = _busy[name]
+        entry[0] += count
+        entry[1] += seconds
+
+
+# Function to record the latency of one request of the given kind ("api", "download"...)
+def record_latency(kind, seconds):
+    with _lock:
+        _latencies[kind].append(seconds)
+
+
+# Function to count an event (a retry, a fallback, a cache hit...)
+def count(name, amount=1):
+    with _lock:
+        counters[name] += amount
+
+
+# Helper function for the nearest-rank percentile of an already sorted list
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# Function to build the metrics document for the run. extra is merged in at the top level
+def snapshot(extra=None):
+    with _lock:
+        stages = {}
+        for name, entry in _stages.items():
+            seconds = entry["seconds"]
+            stages[name] = {
+                **entry,
+                "seconds": round(seconds, 4),
+                "files_per_s": round(entry["files"] / seconds, 2) if seconds else None,
+                "mb_per_s": round(entry["bytes"] / 1024**2 / seconds, 3) if seconds else None,
+            }
+        busy = {name: {"count": n, "seconds": round(seconds, 4), "avg_ms": round(seconds / n * 1000, 3) if n else None}
+                for name, (n, seconds) in _busy.items()}
+        latency = {}
+        for kind, values in _latencies.items():
+            values = sorted(values)
+            latency[kind] = {
+                "count": len(values),
+                "mean_ms": round(sum(values) / len(values) * 1000, 2),
+                "p50_ms": round(_percentile(values, 0.50) * 1000, 2),
+                "p90_ms": round(_percentile(values, 0.90) * 1000, 2),
+                "p99_ms": round(_percentile(values, 0.99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+            }
+        document = {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(_started)),
+            "wall_seconds": round(time.time() - _started, 3),
+            "stages": stages,
+            "busy": busy,
+            "latency": latency,
+            "counters": dict(counters),
+        }
+    document.update(extra or {})
+    return document
+
+
+# Function to write the metrics of the run to <dest>/reports/metrics.json. Returns the path written
+def write_metrics(dest, extra=None):
+    path = Path(dest) / "reports" / "metrics.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(snapshot(extra), f, indent=2)
+    logging.info("Run metrics saved to %s", path)
+    return path
@@ -0,0 +1,115 @@
+import time
+import random
+import logging
+import threading
+import Metrics
+
+# Shared limiter for every request the run sends (category listing, metadata and downloads, from any thread).
+# - A token bucket caps the average rate at --rate requests per second. It holds at most `burst` tokens, so a quiet
+#   spell lets a few requests go back to back but the long run average never goes over the cap
+# - A concurrency window caps how many requests are in flight at once. It grows by about one request per window of
+#   successes and halves on every throttled response (additive increase, multiplicative decrease), between 1 and
+#   the configured maximum. The request rate itself is halved with it and creeps back up to --rate the same way
+# - backoff() pauses every thread until a Retry-After (or maxlag) delay has passed
+_cond = threading.Condition()
+_max_rate = 0.0 # Configured --rate, 0 means no throttling
+_rate = 0.0 # Current tokens per second, between _max_rate / MIN_RATE_DIVISOR and _max_rate
+_burst = 1.0
+_tokens = 1.0
+_last_refill = 0.0 # Monotonic time the bucket was last topped up
+_max_concurrency = 1
+_window = 1.0 # Requests allowed in flight right now (only the integer part counts)
+_in_flight = 0
+_paused_until = 0.0 # Monotonic time before which no request may start
+
+MAXLAG = 5 # Seconds of database replication lag above which the API should refuse our requests (bot etiquette)
+MIN_RATE_DIVISOR = 16 # Throttling never slows the rate below --rate / 16
+BACKOFF_BASE = 1.0 # Seconds before the first retry, doubled on every further attempt
+BACKOFF_CAP = 60.0
+
+
+# Function to set the limits for the run. rate is requests per second (None or 0 disables the rate cap),
+# max_concurrency the most requests in flight at once and burst how many tokens the bucket can save up
+def configure_rate(rate=None, max_concurrency=1, burst=None):
+    global _max_rate, _rate, _burst, _tokens, _last_refill, _max_concurrency, _window, _in_flight, _paused_until
+    with _cond:
+        _max_rate = _rate = float(rate or 0)
+        _burst = float(burst) if burst else max(1.0, _max_rate / 4)
+        _tokens = _burst
+        _last_refill = time.monotonic()
+        _max_concurrency = max(1, max_concurrency or 1)
+        _window = 1.0 # Starts serial and opens up while the API keeps answering
+        _in_flight = 0
+        _paused_until = 0.0
+    logging.info(f"Global request rate set to {rate if rate else 'unlimited'} requests/s, up to {_max_concurrency} in flight")
+
+
+# Helper function to add the tokens earned since the last refill (call with _cond held)
+def _refill(now):
+    global _tokens, _last_refill
+    if _rate:
+        _tokens = min(_burst, _tokens + (now - _last_refill) * _rate)
+    _last_refill = now
+
+
+# Function that blocks the calling thread until it may send its next request. Every acquire() needs a release()
+def acquire():
+    global _tokens, _in_flight
+    with _cond:
+        while True:
+            now = time.monotonic()
+            if now < _paused_until:
+                _cond.wait(_paused_until - now)
+                continue
+            if _in_flight >= int(_window):
+                _cond.wait() # Woken by release()
+                continue
+            _refill(now)
+            if _rate and _tokens < 1:
+                _cond.wait((1 - _tokens) / _rate)
+                continue
+            _tokens -= 1
+            _in_flight += 1
+            return
+
+
+# Function to hand back the slot taken by acquire(). throttled=True for 429/5xx/maxlag answers and network errors
+def release(throttled=False):
+    global _in_flight, _window, _rate
+    with _cond:
+        _in_flight = max(0, _in_flight - 1)
+        if throttled:
+            _window = max(1.0, _window / 2)
+            if _max_rate:
+                _rate = max(_max_rate / MIN_RATE_DIVISOR, _rate / 2)
+        else:
+            _window = min(float(_max_concurrency), _window + 1 / _window)
+            if _max_rate:
+                _rate = min(_max_rate, _rate + _max_rate / 50)
+        _cond.notify_all()
+
+
+# Function to stop every thread from sending anything for the next `seconds` (a Retry-After or maxlag answer)
+def backoff(seconds):
+    global _paused_until
+    seconds = min(max(0.0, seconds), BACKOFF_CAP)
+    with _cond:
+        _paused_until = max(_paused_until, time.monotonic() + seconds)
+        _cond.notify_all()
+    Metrics.count("throttle_pauses")
+    logging.warning("API asked us to slow down, pausing all requests for %.1fs", seconds)
+
+
+# Function to work out how long to wait before retry number `attempt` (0 for the first retry)
+# Exponential with jitter so workers that failed together don't all retry in the same instant; never shorter than
+# the server's own Retry-After
+def backoff_delay(attempt, retry_after=None):
+    ceiling = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)
+    delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+    return max(delay, retry_after or 0)
+
+
+# Function to describe the limiter's current state, for the run metrics
+def limiter_stats():
+    with _cond:
+        return {"rate": round(_rate, 3), "max_rate": _max_rate, "window": round(_window, 2), "max_concurrency": _max_concurrency}
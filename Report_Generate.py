@@ -5,236 +5,353 @@ import argparse
 from datetime import datetime
 from pathlib import Path
 from Logging_Funct import setup_logging
-from pprint import pformat
-from collections import OrderedDict
+from Report_Index import open_report_index, close_report_index, is_complete, dirty_days, store_days, sync_day, finish_full_scan, clean_days, day_rows
+from Metadata_Store import STORE_NAME
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+try: # NumPy is optional, DayStats falls back to the builtin min/max/sum over the arrays without it
+    import numpy as np
+except ImportError:
+    np = None
 
 files_for_report_count = 0  # Counter for more accurate tracking of how many files are looped over for report generation
+SKIP_DIRS = ("logs", "reports", "cache", "state") # Pipeline folders that are never part of a report
 
-def reports(args, dir=None):
+
+# One day folder of the report, stored as columns: file names plus parallel int64 arrays of sizes and mtimes in
+# nanoseconds. Far smaller than a dict entry and formatted string per file, and min/max/sum run over whole columns
+class DayStats:
+    __slots__ = ("names", "sizes", "mtimes_ns", "_summary")
+
+    def __init__(self):
+        self.names = []
+        self.sizes = array("q")
+        self.mtimes_ns = array("q")
+        self._summary = None
+
+    # Builds a day that only knows its aggregates (from the report index), for reports that don't list files
+    @classmethod
+    def from_summary(cls, summary):
+        day = cls()
+        day._summary = tuple(summary)
+        return day
+
+    # Builds a day from (name, size, mtime_ns) rows in name order
+    @classmethod
+    def from_rows(cls, rows):
+        day = cls()
+        for name, size, mtime_ns in rows:
+            day.add(name, size, mtime_ns)
+        return day
+
+    def add(self, name, size, mtime_ns):
+        self.names.append(name)
+        self.sizes.append(size)
+        self.mtimes_ns.append(mtime_ns)
+
+    def __len__(self):
+        return self._summary[0] if self._summary else len(self.names)
+
+    # Returns (file count, total bytes, earliest mtime_ns, latest mtime_ns), vectorised with NumPy when it is installed
+    def summary(self):
+        if self._summary:
+            return self._summary
+        if not self.names:
+            return 0, 0, None, None
+        if np is not None:
+            sizes = np.frombuffer(self.sizes, dtype=np.int64)
+            mtimes = np.frombuffer(self.mtimes_ns, dtype=np.int64)
+            return len(self.names), int(sizes.sum()), int(mtimes.min()), int(mtimes.max())
+        return len(self.names), sum(self.sizes), min(self.mtimes_ns), max(self.mtimes_ns)
+
+
+# Helper function to turn an mtime in nanoseconds into a datetime without losing the microseconds to float rounding
+def ns_to_datetime(mtime_ns):
+    seconds, remainder = divmod(mtime_ns, 10**9)
+    return datetime.fromtimestamp(seconds).replace(microsecond=remainder // 1000)
+
+
+# Function to list one directory with a single os.scandir pass
+# File/dir types come from the cached DirEntry information and every file is stat()ed exactly once
+# Returns (DayStats of the files sorted by name or None if there are none, subdirectory DirEntries sorted by name)
+def scan_directory(directory):
+    files = []
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry)
+            elif entry.is_file() and entry.name != STORE_NAME: # The metadata store describes the files, it isn't one
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError: # Moved or renamed since the listing (a download or organize --watch at work)
+                    continue
+                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    subdirs.sort(key=lambda entry: entry.name)
+    if not files:
+        return None, subdirs
+    files.sort()
+    return DayStats.from_rows(files), subdirs
+
+
+# Helper function for the report order inside one folder: numeric day folders numerically, then the others by name
+def day_sort_key(name):
+    return (0, int(name), "") if name.isdigit() else (1, 0, name)
+
+
+# Helper function for the order of a bucket day path (relative to args.dest) in a report, matching walk_days: inside
+# every folder its day folders come first in day_sort_key order, then its subfolders by name
+def report_order_key(path):
+    parts = path.split("/")
+    return [(1, 0, 0, part) for part in parts[:-1]] + [(0,) + day_sort_key(parts[-1])]
+
+
+# Function to start scanning the children of a folder. Returns [(name, scan)] in name order, where scan is a Future
+# of scan_directory when a pool is given, the path to scan later when not, or None for the indexed bucket tree
+def submit_scans(subdirs, parts=(), buckets=None, pool=None):
+    scans = []
+    for subdir in subdirs:
+        if subdir.name in SKIP_DIRS:
+            logging.debug("Skipping logs, reports, cache and state folders in recursion")
+            continue
+        if buckets is not None and not parts and subdir.name == "buckets":
+            scans.append((subdir.name, None))
+            continue
+        scans.append((subdir.name, pool.submit(scan_directory, subdir.path) if pool else subdir.path))
+    return scans
+
+
+# Function to walk the children of a folder lazily, yielding (path parts relative to args.dest, DayStats) in report order
+# Folders holding files are days (their own subfolders are not reported), the rest are descended into after the days
+# Serially only one folder's children are held at a time, so memory does not grow with the size of the archive.
+# With a pool (report --workers) the scans are submitted ahead: a folder's children are scanned in parallel and the
+# children of its subfolders are queued as soon as they are known (a year's months start listing their days while the
+# first month is written). Results are always taken in name order, so the output is identical to the serial walk
+# buckets is a callable that yields the bucket tree's days instead of walking it (see bucket_days), or None to walk it
+def walk_days(subdirs, parts=(), buckets=None, pool=None, scans=None):
+    if scans is None:
+        scans = submit_scans(subdirs, parts, buckets, pool)
+    days = []
+    folders = []
+    for name, scan in scans:
+        if scan is None:
+            folders.append((name, None, None))
+            continue
+        day, children = scan.result() if pool else scan_directory(scan)
+        if day is not None:
+            days.append((name, day))
+        else: # Queues the next level of this subfolder while the days of this level are being written
+            folders.append((name, children, submit_scans(children, parts + (name,), None, pool) if pool else None))
+    days.sort(key=lambda item: day_sort_key(item[0]))
+    for name, day in days:
+        yield parts + (name,), day
+    del days
+    for name, children, child_scans in folders:
+        if children is None: # The bucket tree comes from the report index instead of a walk
+            yield from buckets()
+        else:
+            yield from walk_days(children, parts + (name,), pool=pool, scans=child_scans)
+
+
+# Function to yield every day of the report in order, (path parts relative to args.dest, DayStats)
+# --workers scans that many folders at the same time
+def iter_report_days(args):
     global files_for_report_count
-    if dir == None: dir = Path.cwd()/args.dest
-    data = OrderedDict() # Initialize an ordered dict object
-    directory_size_sum=0 # Counter for size of files in directory. Will be reset for each directory
-    directory_files_count=0 # Counter for number of files in a directory. Will reset for each directory
-    logging.debug(f"Iterating through {dir} to see if directory or file (reports function)")
-    for subdir in sorted(dir.iterdir()):
-        if subdir.is_dir():
-            if subdir.name == "logs" or subdir.name == "reports":
-                logging.debug("Skipping logs folder in recursion")
-                continue
-            logging.debug(f"{subdir} is a directory, new dictionary nested. Continuing recursively until file found")
-            # Below starts the recursion
-            sub_data = reports(args, subdir)
-            if sub_data: data[subdir.name] = sub_data # Only include folders that contain files
-        elif subdir.is_file():
-            timestamp=(datetime.fromtimestamp(subdir.stat().st_mtime)).strftime("%c")
-            directory_size_sum+=subdir.stat().st_size
-            directory_files_count+=1
-            files_for_report_count+=1
-            logging.info(f"File was found. New key:value pair entered into data dictionary as {subdir.name}:{(datetime.fromtimestamp(subdir.stat().st_mtime)).strftime("%c")}")
-            data[f"{subdir.name}"] = timestamp
-    if directory_files_count >=1:
-        data["__dir_size__"] = f"{directory_size_sum/(1024**2):.2f}MB"
-        data["__file_count__"] = directory_files_count
-    logging.debug(f" the final dictionary is now {pformat(data)}")
-    logging.info(f"Dictionary of data for report compiled and returned.")
-    return data
+    root = Path.cwd() / args.dest
+    open_report_index(args.dest)
+    workers = max(1, getattr(args, "workers", 1) or 1)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report") if workers > 1 else None
+    try:
+        _, subdirs = scan_directory(root)
+        for parts, day in walk_days(subdirs, buckets=lambda: bucket_days(args, root, pool), pool=pool):
+            files_for_report_count += len(day)
+            yield parts, day
+    finally:
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Helper function to rescan one indexed day. Returns its DayStats, or None when the folder is gone or empty
+def rescan_day(day_dir):
+    try:
+        day, _ = scan_directory(day_dir)
+    except FileNotFoundError: # The day folder was emptied and removed since it was marked
+        day = None
+    return day
+
+
+# Function to yield the bucket tree's days in report order from the report index (see Report_Index), rescanning only
+# the days Sort_Files marked dirty. The tree is walked instead when the index has never been filled or --full-rescan is
+# passed, and the index is checked against that walk as it goes
+# File rows are only read from the index for the JSON report, the Markdown report needs nothing but the aggregates
+def bucket_days(args, root, pool=None):
+    if getattr(args, "full_rescan", False) or not is_complete():
+        _, subdirs = scan_directory(root / "buckets")
+        seen = set()
+        drift = Counter()
+        for parts, day in walk_days(subdirs, ("buckets",), pool=pool):
+            path = "/".join(parts)
+            seen.add(path)
+            drift[sync_day(path, day)] += 1
+            yield parts, day
+        removed = finish_full_scan(seen)
+        logging.info(f"Full rescan of {len(seen)} bucket days: index had {drift['added']} days missing, {drift['changed']} out of date and {removed} no longer on disk")
+        return
+    dirty = dirty_days()
+    day_dirs = [root / path for path in dirty]
+    rescanned = dict(zip(dirty, pool.map(rescan_day, day_dirs) if pool else map(rescan_day, day_dirs)))
+    store_days(rescanned)
+    logging.info(f"Report index: rescanned {len(dirty)} dirty bucket days")
+    with_files = bool(args.json)
+    for path, summary in sorted(clean_days(), key=lambda item: report_order_key(item[0])):
+        yield tuple(path.split("/")), DayStats.from_rows(day_rows(path)) if with_files else DayStats.from_summary(summary)
+
 
 # Function to properly call the helper functions based on CLI modifiers
+# The tree is visited once and every requested report is written a day at a time as it goes
 def create_report(args,):
-    data = reports(args) # Calls the data generating function and saves the returned nested dictionary
-    if args.md: # Calls the md creating helper function if --md passed in CLI
-        md_text = generate_human_readable(data)
-        md_file = Path(args.dest) / "reports" / "report.md"
-        md_file.parent.mkdir(parents=True, exist_ok=True)
-        logging.debug(f"markdown report file created")
-        with open(md_file, "w") as f:
-            f.write(md_text) # Creates the MD file
+    reports_dir = Path(args.dest) / "reports"
+    reports_dir.mkdir(parents=True, exist_ok=True)
+    json_format = getattr(args, "json_format", "pretty") or "pretty"
+    md_file = reports_dir / "report.md"
+    json_file = reports_dir / ("manifest.ndjson" if json_format == "ndjson" else "manifest.json")
+    md_out = open(md_file, "w") if args.md else None # Calls the md writer if --md passed in CLI
+    json_out = open(json_file, "w") if args.json else None # Calls the .json writer if --json passed in CLI
+    json_writer = JsonReportWriter(json_out, args.dest, json_format) if json_out else None
+    try:
+        for parts, day in iter_report_days(args):
+            if md_out:
+                write_markdown_day(md_out, parts, day)
+            if json_writer:
+                json_writer.write_day(parts, day)
+        if json_writer:
+            json_writer.close()
+    finally:
+        close_report_index()
+        for out in (md_out, json_out):
+            if out:
+                out.close()
+    if md_out:
         logging.info(f"markdown report saved to {md_file}")
-    if args.json: #Calls the .json producing helper function if --json passed in CLI
-        json_file = Path(args.dest) / "reports" / "manifest.json"
-        report_json = generate_machine_readable_json(data, args)
-        with open(json_file, "w") as f:
-            json.dump(report_json, f, indent=4) # Creates the .json files
-        logging.info(f"JSON report file created and saved to {json_file}")
+    if json_out:
+        logging.info(f"JSON report file ({json_format}) created and saved to {json_file}")
 
 # Helper function for smart unit conversion of file byte size
 def bytes_to_human_readable(num_bytes):
     #Convert bytes to human-readable string (B, KB, MB, GB).
     for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
         if num_bytes < 1024.0:
-            logging.info(f"{num_bytes:.2f}{unit} in file")
             return f"{num_bytes:.2f}{unit}"
         num_bytes /= 1024.0
     return f"{num_bytes:.2f}TB"
 
-# Function to generate a markdown report of the files for human readability
-def generate_human_readable(data, path_prefix=""):
-    # Recursively generate Markdown tables for each day in nested dictionary data.
-    # Sorted chronologically by day.
-    md_output = ""
-    # Separate day-level entries from subfolders
-    day_entries = []
-    subfolders = []
-    for key, value in data.items():
-        if isinstance(value, dict) and "__file_count__" in value:
-            day_entries.append((key, value))
-            logging.info(f"new day entry added to markdown report file")
-        elif isinstance(value, dict):
-            subfolders.append((key, value))
-    numeric_files = [(k, v) for k, v in day_entries if k.isdigit()] # Separate numeric day folders vs other folders
-    other_files = [(k, v) for k, v in day_entries if not k.isdigit()] # Separate numeric day folders vs other folders
-    numeric_files.sort(key=lambda x: int(x[0])) # Sort numeric days numerically
-    sorted_day_entries = numeric_files + other_files # Keep other_days in their original order (or sort alphabetically if preferred)
-    for day_key, day_value in sorted_day_entries: # Generate tables for each day
-        day_path = f"{path_prefix}/{day_key}" if path_prefix else day_key
-        logging.debug("Day path created in .md report for all folders in args.dest target folder")
-        trimmed_path = "/".join(day_path.split("/")[1:]) if "/" in day_path else day_path  # Trim off the root (first folder) for the table
-        logging.debug("Created a trimmed path without the parent directory included for prettier report table creation for .md report")
-        human_readable_date = trimmed_path # Convert YYYY/MM/DD into human-readable format
-        try:
-            parts = trimmed_path.split("/")
-            if len(parts) >= 3:
-                year, month, day = parts[0], parts[1], parts[2]
-                dt = datetime(int(year), int(month), int(day))
-                human_readable_date = dt.strftime("%b %d, %Y")  # e.g., Sep 20, 2025
-                logging.debug("Changed date for .md report into a more human reading friendly format")
-        except Exception as e:
-            logging.warning(f"Could not parse date from {trimmed_path}: {e}")
-        md_report_header = f"{path_prefix}/{day_key}" if path_prefix else day_key
-        logging.debug("Created header for .md report")
-        file_count = day_value.get("__file_count__", 0)
-        logging.debug("File count set from data table already generated")
-        total_bytes_str = day_value.get("__dir_size__", "0B")
-        if isinstance(total_bytes_str, (int, float)):  # Convert total bytes to human-readable using helper function
-            total_bytes_str = bytes_to_human_readable(total_bytes_str)
-            logging.debug("Converted the byte size of the folder back to bytes and set it")
-        mtimes = [ # Collect mtimes
-            datetime.strptime(ts, "%c")
-            for f, ts in day_value.items()
-            if f not in ["__file_count__", "__dir_size__"]
-        ]
-        logging.debug(f"collected list of mtimes for each file in day folder to sort through for markdown report")
-        earliest = min(mtimes).strftime("%B %d, %Y %H:%M:%S") if mtimes else "N/A"
-        latest = max(mtimes).strftime("%B %d, %Y %H:%M:%S") if mtimes else "N/A"
-        logging.debug(f"Found min mtime {earliest} and max mtime {latest}")
-        headers = ["Date", "File Count", "Total Size", "Earliest mtime", "Latest mtime"] # Prepare table data
-        rows = [[human_readable_date, str(file_count), total_bytes_str, earliest, latest]]
-        logging.debug(f"table headers and rows prepped")
-        col_widths = [max(len(row[i]) for row in [headers] + rows) for i in range(len(headers))]  # Compute max width for each column
-        logging.debug(f"max column width calculated for table formatting")
-        # Build Markdown table with aligned columns
-        md_output += f"### {md_report_header}\n\n" 
-        md_output += "| " + " | ".join(f"{headers[i]:{col_widths[i]}}" for i in range(len(headers))) + " |\n"
-        md_output += "|-" + "-|-".join("-"*w for w in col_widths) + "-|\n"
-        logging.debug(f"built markdown table using column alignment")
-        for row in rows:
-            md_output += "| " + " | ".join(f"{row[i]:{col_widths[i]}}" for i in range(len(headers))) + " |\n"
-            logging.debug(f"Added extra rows to report as needed")
-        md_output += "\n"
-    # Recurse into subfolders
-    for sub_key, sub_value in subfolders:
-        new_prefix = f"{path_prefix}/{sub_key}" if path_prefix else sub_key
-        logging.debug(f"recoursed into subfolders as necessary to produce markdown table report for every day folder present")
-        md_output += generate_human_readable(sub_value, new_prefix,)
-    logging.debug(f"Markdown report fully generated")
-    return md_output
-
-
-
-
-# Function to create a machine readable report .json file 
-def generate_machine_readable_json(data, args, path_prefix=None,):
-    # Recursively generate a machine-readable JSON structure with:
-    # - File count
-    # - Total size (in bytes)
-    # - Earliest and latest mtime
-    # Keeps the nested folder structure.
-    report_json = {} # Create empty dictionary variable for later use
-    # Ensure the relative path starts from args.dest target passed in CLI
-    if path_prefix is None:
-        path_prefix = args.dest if args else "" # Start path with the top-level project folder if args.dest not passed
-    # Separate day-level entries from subfolders and create their empty variables for later use
-    day_entries = []
-    subfolders = []
-    logging.debug(f"{report_json}, {day_entries}, and {subfolders} created/updated")
-    for key, value in data.items():
-        if isinstance(value, dict) and "__file_count__" in value:
-            day_entries.append((key, value))
-            logging.debug("day entries object updated ")
-        elif isinstance(value, dict):
-            subfolders.append((key, value))
-            logging.debug("subfolders object updated")
-    numeric_files = [(k, v) for k, v in day_entries if k.isdigit()] # Separate numeric day folders vs other folders
-    other_files = [(k, v) for k, v in day_entries if not k.isdigit()] # Separate numeric day folders vs other folders
-    numeric_files.sort(key=lambda x: int(x[0])) # Sort numeric days numerically
-    sorted_day_entries = numeric_files + other_files # Keep other_days in their original order (or sort alphabetically if preferred)
-    logging.info("day_entries object sorted by day integer in decreasing order")
-    for day_key, day_value in sorted_day_entries:  # Process day-level entries
-        day_path = f"{path_prefix}/{day_key}" if path_prefix else day_key
-        file_count = day_value.get("__file_count__", 0)
-        total_bytes = day_value.get("__dir_size__", 0)
-        logging.debug("entries for each day processed to put into .json file")
-        if isinstance(total_bytes, str) and total_bytes.endswith("MB"): # Convert human-readable MB string back to bytes if necessary
-            total_bytes = float(total_bytes.replace("MB", "")) * 1024**2
-            logging.debug("Human readable bytes cinverted to bytes if needed")
-        elif isinstance(total_bytes, str) and total_bytes.endswith("GB"):
-            total_bytes = float(total_bytes.replace("GB", "")) * 1024**3
-            logging.debug("Human readable bytes cinverted to bytes if needed")
-        # Collect mtimes
-        mtimes = [
-            datetime.strptime(ts, "%c")
-            for f, ts in day_value.items()
-            if f not in ["__file_count__", "__dir_size__"]
-        ]
-        logging.debug("Mtimes collected for .json report")
-        earliest = min(mtimes).isoformat() if mtimes else None
-        latest = max(mtimes).isoformat() if mtimes else None
-        logging.debug("earliest and latest mtimes found and stored as variables for .json report")
-        # Build folder summary
-        folder_entry = {
-            "path": day_path,
-            "file_count": file_count,
-            "total_bytes": int(total_bytes),
-            "earliest_mtime": earliest,
-            "latest_mtime": latest,
-            "files": []
-        }
-        logging.debug("summary of folder created")
-        # Add each file in this folder
-        for f, ts in day_value.items():
-            if f in ["__file_count__", "__dir_size__"]:
-                logging.warning("directories that do not contain files skipped in .json report building")
-                continue
-            file_rel_path = f"{day_path}/{f}"
-            file_mtime = datetime.strptime(ts, "%c").isoformat()
-            file_size = None
-            logging.debug("file path and size for each file retrieved for .json report")
-            # Look up size of each file from the actual filesystem 
-            try:
-                abs_path = Path(args.dest) / Path(file_rel_path).relative_to(args.dest)
-                if abs_path.exists():
-                    file_size = abs_path.stat().st_size
-                    logging.debug("File size retrieved from system for .json report")
-            except Exception:
-                file_size = 0
-            folder_entry["files"].append({
-                "path": file_rel_path,
-                "size": file_size,
-                "mtime": file_mtime
-            })
-            logging.debug(f"files key in folder dictionary of .json reported filled with path, size, and mtime of each file within the folder")
-        report_json[day_key] = folder_entry # Add the entire folder entry to the report
-        logging.debug("Built the .json report dictionary")
-    # Recurse into subfolders
-    for sub_key, sub_value in subfolders:
-        new_prefix = f"{path_prefix}/{sub_key}" if path_prefix else sub_key
-        logging.debug("Recurse into subfolders if they have files in them")
-        sub_report = generate_machine_readable_json(sub_value, new_prefix, args)
-        if sub_report:  # Only include folders that have files
-            logging.debug("Should only trigger for subfolders with files in them eventually")
-            report_json[sub_key] = sub_report
-    return report_json
+# Function to write the markdown table of one day to the report file
+def write_markdown_day(out, parts, day):
+    day_path = "/".join(parts)
+    trimmed_path = "/".join(parts[1:]) if len(parts) > 1 else day_path  # Trim off the root (first folder) for the table
+    human_readable_date = trimmed_path # Convert YYYY/MM/DD into human-readable format
+    try:
+        date_parts = trimmed_path.split("/")
+        if len(date_parts) >= 3:
+            year, month, day_of_month = date_parts[0], date_parts[1], date_parts[2]
+            dt = datetime(int(year), int(month), int(day_of_month))
+            human_readable_date = dt.strftime("%b %d, %Y")  # e.g., Sep 20, 2025
+            logging.debug("Changed date for .md report into a more human reading friendly format")
+    except Exception as e:
+        logging.warning("Could not parse date from %s: %s", trimmed_path, e)
+    file_count, total_bytes, earliest_ns, latest_ns = day.summary()
+    logging.debug("File count, size and mtime span computed from the day's columns")
+    earliest = ns_to_datetime(earliest_ns).strftime("%B %d, %Y %H:%M:%S") if earliest_ns is not None else "N/A"
+    latest = ns_to_datetime(latest_ns).strftime("%B %d, %Y %H:%M:%S") if latest_ns is not None else "N/A"
+    headers = ["Date", "File Count", "Total Size", "Earliest mtime", "Latest mtime"] # Prepare table data
+    rows = [[human_readable_date, str(file_count), bytes_to_human_readable(total_bytes), earliest, latest]]
+    col_widths = [max(len(row[i]) for row in [headers] + rows) for i in range(len(headers))]  # Compute max width for each column
+    # Build Markdown table with aligned columns
+    section = [f"### {day_path}\n\n"]
+    section.append("| " + " | ".join(f"{headers[i]:{col_widths[i]}}" for i in range(len(headers))) + " |\n")
+    section.append("|-" + "-|-".join("-"*w for w in col_widths) + "-|\n")
+    for row in rows:
+        section.append("| " + " | ".join(f"{row[i]:{col_widths[i]}}" for i in range(len(headers))) + " |\n")
+    section.append("\n")
+    out.write("".join(section))
+    logging.debug("Markdown section written for %s", day_path)
+
+
+# Function to build the machine readable entry of one day: file count, total size in bytes, earliest and latest mtime
+# and every file, with paths starting from args.dest
+def day_entry(dest, parts, day):
+    day_path = "/".join((dest,) + tuple(parts)) if dest else "/".join(parts)
+    file_count, total_bytes, earliest_ns, latest_ns = day.summary()
+    return {
+        "path": day_path,
+        "file_count": file_count,
+        "total_bytes": total_bytes,
+        "earliest_mtime": ns_to_datetime(earliest_ns).isoformat() if earliest_ns is not None else None,
+        "latest_mtime": ns_to_datetime(latest_ns).isoformat() if latest_ns is not None else None,
+        "files": [
+            {"path": f"{day_path}/{name}", "size": size, "mtime": ns_to_datetime(mtime_ns).isoformat()}
+            for name, size, mtime_ns in zip(day.names, day.sizes, day.mtimes_ns)
+        ],
+    }
+
+
+# Writes the JSON report while the days stream past, keeping only the keys of the currently open folders in memory
+# "pretty" gives the same document json.dump(indent=4) wrote for the nested report, "compact" the same document without
+# whitespace, and "ndjson" one day entry per line (its path carries the folder structure)
+class JsonReportWriter:
+    def __init__(self, out, dest, json_format="pretty"):
+        self.out = out
+        self.dest = dest
+        self.json_format = json_format
+        self.indent = 4 if json_format == "pretty" else None
+        self.open_keys = [] # Folder keys of the currently open nested objects, below the root object
+        self.empty = [True] # Per open object (root first): nothing written into it yet
+        if json_format != "ndjson":
+            out.write("{")
+
+    def _newline(self, depth):
+        return "\n" + " " * (self.indent * depth) if self.indent else ""
+
+    def _write_key(self, key):
+        separator = "" if self.empty[-1] else ","
+        self.empty[-1] = False
+        colon = ": " if self.indent else ":"
+        self.out.write(f"{separator}{self._newline(len(self.open_keys) + 1)}{json.dumps(key)}{colon}")
+
+    def _close_object(self):
+        self.open_keys.pop()
+        self.empty.pop()
+        self.out.write(f"{self._newline(len(self.open_keys) + 1)}}}")
+
+    def write_day(self, parts, day):
+        entry = day_entry(self.dest, parts, day)
+        if self.json_format == "ndjson":
+            self.out.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            return
+        folders = list(parts[:-1])
+        common = 0
+        while common < min(len(folders), len(self.open_keys)) and folders[common] == self.open_keys[common]:
+            common += 1
+        while len(self.open_keys) > common: # Leaving folders whose days are all written
+            self._close_object()
+        for key in folders[common:]: # Entering the folders this day sits in
+            self._write_key(key)
+            self.out.write("{")
+            self.open_keys.append(key)
+            self.empty.append(True)
+        self._write_key(parts[-1])
+        if self.indent:
+            self.out.write(json.dumps(entry, indent=self.indent).replace("\n", self._newline(len(self.open_keys) + 1)))
+        else:
+            self.out.write(json.dumps(entry, separators=(",", ":")))
+
+    def close(self):
+        if self.json_format == "ndjson":
+            return
+        while self.open_keys:
+            self._close_object()
+        self.out.write("}" if self.empty[0] else f"{self._newline(0)}}}")
 
 
 # Only used for file creation and debugging. Not used in the production code. Kept in case further debugging needed.
@@ -0,0 +1,150 @@
+import os
+import logging
+from pathlib import Path
+from Sqlite_Index import SharedConnection
+
+# Persistent per-day aggregates of the bucket tree, stored in <dest>/reports/day_index.sqlite.
+# Holds every day folder's file count, total bytes and mtime span (plus its file rows for the JSON report).
+# Sort_Files marks a day dirty whenever it places a file there, and create_report rescans only the dirty days,
+# so a report after a small organize run costs a few scandirs instead of a walk of the whole archive
+_root = None # Absolute <dest> the day paths are stored relative to
+_marked = set() # Days already marked dirty by this process, so each day costs one write per run
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    path TEXT PRIMARY KEY,
+    file_count INTEGER,
+    total_bytes INTEGER,
+    earliest_ns INTEGER,
+    latest_ns INTEGER,
+    dirty INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    day TEXT,
+    name TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    PRIMARY KEY (day, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+_db = SharedConnection(SCHEMA) # One connection shared by every sort worker
+
+
+# Function to open (or create) the report index for a destination folder. Calling it again for the same folder is a no-op
+def open_report_index(dest):
+    global _root
+    root = os.path.abspath(dest)
+    if not _db.open(Path(root) / "reports" / "day_index.sqlite"):
+        return
+    with _db.lock:
+        _root = root
+        _marked.clear()
+    logging.info(f"Report index opened at {_db.path}")
+
+
+# Function to close the report index at the end of a run
+def close_report_index():
+    global _root
+    _db.close()
+    with _db.lock:
+        _root = None
+        _marked.clear()
+
+
+# Function to flag the day folder a file was just placed in, so the next report rescans it
+def mark_dirty(day_dir):
+    if _db.conn is None:
+        return
+    path = Path(os.path.relpath(os.path.abspath(day_dir), _root)).as_posix()
+    with _db.lock:
+        if path in _marked:
+            return
+        _db.conn.execute(
+            "INSERT INTO days (path, file_count, total_bytes, dirty) VALUES (?, 0, 0, 1) ON CONFLICT(path) DO UPDATE SET dirty = 1",
+            (path,),
+        )
+        _db.conn.commit()
+        _marked.add(path)
+
+
+# Function to tell whether the index has been filled by a full scan yet (until then it can't stand in for one)
+def is_complete():
+    with _db.lock:
+        row = _db.conn.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone()
+    return row is not None
+
+
+# Function to list the day paths (relative to <dest>) that changed since their last scan
+def dirty_days():
+    with _db.lock:
+        return [path for (path,) in _db.conn.execute("SELECT path FROM days WHERE dirty = 1 ORDER BY path")]
+
+
+# Helper function to write one scanned day (anything with names/sizes/mtimes_ns columns and summary()), or drop it if None
+def _write_day(path, day):
+    _db.conn.execute("DELETE FROM files WHERE day = ?", (path,))
+    if day is None or not len(day):
+        _db.conn.execute("DELETE FROM days WHERE path = ?", (path,))
+        return
+    count, total_bytes, earliest_ns, latest_ns = day.summary()
+    _db.conn.execute(
+        "INSERT OR REPLACE INTO days (path, file_count, total_bytes, earliest_ns, latest_ns, dirty) VALUES (?, ?, ?, ?, ?, 0)",
+        (path, count, total_bytes, earliest_ns, latest_ns),
+    )
+    _db.conn.executemany(
+        "INSERT INTO files (day, name, size, mtime_ns) VALUES (?, ?, ?, ?)",
+        ((path, name, size, mtime_ns) for name, size, mtime_ns in zip(day.names, day.sizes, day.mtimes_ns)),
+    )
+
+
+# Function to store freshly rescanned days. days maps a day path to its columns, or None when the folder is now empty
+def store_days(days):
+    with _db.lock:
+        for path, day in days.items():
+            _write_day(path, day)
+        _db.conn.commit()
+        _marked.difference_update(days)
+
+
+# Function to bring one day in line with a full scan of the tree, as the scan reaches it
+# Returns "added" or "changed" when the index disagreed with the disk (a dirty day was expected to change), else None
+def sync_day(path, day):
+    with _db.lock:
+        row = _db.conn.execute("SELECT file_count, total_bytes, earliest_ns, latest_ns, dirty FROM days WHERE path = ?", (path,)).fetchone()
+        _write_day(path, day)
+        _db.conn.commit()
+    if row is None:
+        return "added"
+    if not row[4] and tuple(row[:4]) != tuple(day.summary()):
+        return "changed"
+    return None
+
+
+# Function to finish a full scan: drops the days the scan did not find and marks the index as complete
+# Returns how many indexed days were no longer on disk
+def finish_full_scan(seen):
+    with _db.lock:
+        gone = [path for (path,) in _db.conn.execute("SELECT path FROM days") if path not in seen]
+        for path in gone:
+            _write_day(path, None)
+        _db.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', '1')")
+        _db.conn.commit()
+        _marked.clear()
+    return len(gone)
+
+
+# Function to list every indexed day as (path, (file count, total bytes, earliest_ns, latest_ns)), without file rows
+def clean_days():
+    with _db.lock:
+        return [(path, tuple(summary)) for path, *summary in
+                _db.conn.execute("SELECT path, file_count, total_bytes, earliest_ns, latest_ns FROM days WHERE dirty = 0")]
+
+
+# Function to read the file rows of one day as (name, size, mtime_ns) tuples in name order
+def day_rows(path):
+    with _db.lock:
+        return _db.conn.execute("SELECT name, size, mtime_ns FROM files WHERE day = ? ORDER BY name", (path,)).fetchall()
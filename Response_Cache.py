@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+# On-disk cache of per-file imageinfo answers under <dest>/cache/, keyed by the normalised request parameters (one
+# page ID plus the imageinfo properties asked for). Category listings are never cached. MediaWiki sends no ETag or
+# Last-Modified for API queries, so a cached listing can't be revalidated and would hide new uploads until it expired.
+# A file's imageinfo only changes when a new version is uploaded, so it keeps for DEFAULT_TTL_HOURS. Every entry
+# carries its own expiry time, and the least recently used entries are evicted above the size cap
+DEFAULT_TTL_HOURS = 168 # A re-uploaded file is noticed within a week, or at once with --refresh
+DEFAULT_MAX_MB = 512
+
+_lock = threading.Lock()
+_cache_dir = None # None means the cache is disabled (--no-cache, or configure_cache never called)
+_ttl = DEFAULT_TTL_HOURS * 3600
+_max_bytes = DEFAULT_MAX_MB * 1024**2
+_refresh = False # --refresh treats every entry as expired, so it is fetched again
+_total_bytes = 0
+cache_stats = {"hits": 0, "misses": 0, "evicted": 0}
+
+
+# Function to switch the cache on for a run. Sizes up the existing cache once so eviction knows where it stands
+def configure_cache(dest, enabled=True, refresh=False, ttl_hours=DEFAULT_TTL_HOURS, max_mb=DEFAULT_MAX_MB):
+    global _cache_dir, _ttl, _max_bytes, _refresh, _total_bytes
+    if not enabled:
+        _cache_dir = None
+        logging.info(f"API response cache disabled")
+        return
+    _cache_dir = Path(dest) / "cache"
+    _cache_dir.mkdir(parents=True, exist_ok=True)
+    _ttl = ttl_hours * 3600
+    _max_bytes = max_mb * 1024**2
+    _refresh = refresh
+    _total_bytes = sum(entry.stat().st_size for entry in _cache_dir.glob("*/*.json"))
+    logging.info(f"API response cache at {_cache_dir} ({_total_bytes / 1024**2:.2f}MB used, ttl {ttl_hours}h, cap {max_mb}MB{', refresh' if refresh else ''})")
+
+
+# Function to build the cache key for a request: the same url and parameters in any order give the same key
+def cache_key(url, params):
+    normalised = json.dumps([url, sorted((str(k), str(v)) for k, v in params.items())])
+    return hashlib.sha256(normalised.encode("utf-8")).hexdigest()
+
+
+def _entry_path(key):
+    return _cache_dir / key[:2] / f"{key}.json"
+
+
+# Function to look up a cached answer. Returns its data, or None when there is no fresh entry
+def lookup(key):
+    if _cache_dir is None:
+        return None
+    path = _entry_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        entry = None
+    if entry is None or _refresh or entry.get("expires_at", 0) <= time.time():
+        with _lock:
+            cache_stats["misses"] += 1
+        return None
+    os.utime(path) # Marks the entry as recently used for LRU eviction
+    with _lock:
+        cache_stats["hits"] += 1
+    return entry["data"]
+
+
+# Function to store an answer and evict old entries if the cache is over its cap
+def store(key, data):
+    global _total_bytes
+    if _cache_dir is None:
+        return
+    entry = {
+        "stored_at": time.time(),
+        "expires_at": time.time() + _ttl,
+        "data": data,
+    }
+    path = _entry_path(key)
+    path.parent.mkdir(exist_ok=True)
+    old_size = path.stat().st_size if path.exists() else 0
+    tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entry, f, separators=(",", ":"))
+    os.replace(tmp_path, path) # Readers never see a half written entry
+    with _lock:
+        _total_bytes += path.stat().st_size - old_size
+        over_cap = _total_bytes > _max_bytes
+    if over_cap:
+        _evict()
+
+
+# Function to delete least recently used entries until the cache is back under 90% of its cap
+def _evict():
+    global _total_bytes
+    with _lock:
+        entries = []
+        for path in _cache_dir.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        _total_bytes = sum(size for _, size, _ in entries)
+        target = _max_bytes * 0.9
+        for _, size, path in entries:
+            if _total_bytes <= target:
+                break
+            path.unlink(missing_ok=True)
+            _total_bytes -= size
+            cache_stats["evicted"] += 1
+    logging.info(f"API response cache evicted down to {_total_bytes / 1024**2:.2f}MB")
+
+
+# Function to log how the cache was used this run
+def log_cache_stats():
+    if _cache_dir is not None:
+        logging.info(f"imageinfo cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evicted']} evicted")
@@ -1,121 +1,413 @@
 import os
+import re
 import json
+import time
+import errno
+import hashlib
 import logging
+import itertools
 from datetime import datetime, timezone
 from pathlib import Path
 import shutil
-from Download_Files import parse_fallback_datetime
+from Download_Files import parse_fallback_datetime, to_utc_iso
 import argparse
-from Logging_Funct import setup_logging
+from concurrent.futures import ThreadPoolExecutor
+from Logging_Funct import setup_logging, FILE
+from Download_Index import open_index, update_location
+from Report_Index import open_report_index, mark_dirty
+from Metadata_Store import STORE_NAME, sidecar_path, read_store, append_record, remove_record, compact
+import Metrics
+try: # Needed for the FICLONE ioctl behind --mode reflink, not available on Windows
+    import fcntl
+except ImportError:
+    fcntl = None
 
 cwd = os.getcwd() #Define the current working directory globally for functions in this file
-# Function to convert a datetime to a UTC based ISO string.
-def to_utc_iso(dt: datetime) -> str:
-    if dt.tzinfo is None: # if no timezone, set timezone to use UTC time
-        dt = dt.replace(tzinfo=timezone.utc)
-    else:
-        dt = dt.astimezone(timezone.utc) # Even if there is a timezone, set the timezone to UTC timezone from whatever timezone it was
-    return dt.isoformat().replace("+00:00", "Z") # Return the mtime format, formatted properly
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png") # Only these images are paired with their .meta.json and sorted
+FICLONE = 0x40049409 # Linux ioctl that makes dst share src's blocks copy-on-write (btrfs, XFS, bcachefs...)
+LINK_FALLBACK_ERRORS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM, errno.EMLINK, errno.ENOSYS)
+_no_reflink_devices = set() # st_dev of filesystems that refused FICLONE, so later files go straight to the copy fallback
+HASH_CHUNK = 1024 * 1024 # Files are hashed 1 MiB at a time so large originals never sit in memory
+_bucket_sizes = {} # bucket dir -> {size: [paths]}, built with one scandir the first time a bucket is checked for duplicates
+_file_hashes = {} # path -> sha1, so every file is hashed at most once per run
+_next_suffix = {} # bucket dir -> (its names from one listdir the first time it needs a suffix, {(base, ext): next free _N})
+PLAN_CHUNK = 64 # Sidecars read per worker in each round of planning
+_store_names = {} # bucket dir -> names with a record in its _metadata.jsonl, read once per bucket
 
 # Function to choose which files are wanted for sorting
-def file_to_sort(args):
+# Work is grouped by target day bucket: every bucket is handled by one worker, so collision handling inside a
+# bucket stays deterministic, while different buckets are sorted in parallel with --workers
+# compact_incoming=False leaves incoming/_metadata.jsonl uncompacted (organize --watch, where a fetch may be appending)
+def file_to_sort(args, compact_incoming=True):
     incoming_path = Path(cwd) / args.dest/ "incoming" # Sets the path to the incoming folder (which is where fetched files go)
     if not incoming_path.exists(): # Checks the incoming path was set correctly and adds the check to the logging for debugging help
         logging.warning(f"Incoming folder {incoming_path} does not exist. Nothing to sort.")
         return
-    json_files = list(incoming_path.glob("*.json"))
-    if not json_files: # Adds check for .json files being found to the log for debugging
-        logging.warning(f"No JSON files found in {incoming_path}, skipping sorting")
+    open_index(args.dest) # So moved files keep their download index entry pointing at the right place
+    open_report_index(args.dest) # So the next report knows which day folders changed
+    with os.scandir(incoming_path) as entries: # Names, not Path objects, for folders holding a big backlog
+        json_files = sorted(entry.name for entry in entries if entry.name.endswith(".json") and entry.is_file())
+    records = read_store(incoming_path) # Metadata fetched with --metadata-store jsonl
+    if not json_files and not records: # Adds check for .json files being found to the log for debugging
+        logging.warning(f"No JSON files or {STORE_NAME} records found in {incoming_path}, skipping sorting")
         return
-    for json_file in json_files:
-        with open(json_file, "r") as f:
-            meta = json.load(f) # Get the meta data from each json file being sorted
-        # Extract canonical timestamp from metadata
+    started = time.perf_counter()
+    buckets = {} # bucket dir -> [(sidecar name or None, image name or None, file_mtime, pageid, record)] in file name order
+    workers = max(1, getattr(args, "workers", 1) or 1)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sort") as pool:
+        # Sidecars are read by the pool too. A plan keeps only what sorting needs, not the sidecar's whole metadata
+        plans = plan_sidecars(pool, json_files, incoming_path, workers)
+        for plan in itertools.chain(plans, (plan_record(filename, meta, incoming_path) for filename, meta in sorted(records.items()))):
+            if plan:
+                buckets.setdefault(bucket_dir(args, plan[2]), []).append(plan)
+        for new_dir_path in buckets: # Every target directory is created up front in one pass
+            os.makedirs(new_dir_path, exist_ok=True)
+        logging.info(f"Sorting {len(json_files)} metadata files and {len(records)} {STORE_NAME} records into {len(buckets)} buckets with {workers} worker(s)")
+        results = list(pool.map(lambda plans: sort_bucket(plans, args, incoming_path), buckets.values()))
+    if records and compact_incoming:
+        compact(incoming_path) # Drops the records of the files that were moved out (removes the store once it is empty)
+    elapsed = time.perf_counter() - started
+    files_done = sum(count for count, _ in results)
+    bytes_done = sum(size for _, size in results)
+    Metrics.add_files("sort", files_done, bytes_done)
+    logging.info(f"Organize summary: {files_done} files ({bytes_done / 1024**2:.2f}MB) in {len(buckets)} buckets, "
+                 f"{elapsed:.2f}s, {files_done / elapsed if elapsed else 0:.1f} files/s, {bytes_done / 1024**2 / elapsed if elapsed else 0:.2f}MB/s")
+
+# Function to plan every sidecar (by name) over the pool, a few hundred at a time so pending futures don't pile up
+def plan_sidecars(pool, json_files, incoming_path, workers):
+    chunk = workers * PLAN_CHUNK
+    for i in range(0, len(json_files), chunk):
+        yield from pool.map(lambda name: plan_sort(incoming_path / name, incoming_path), json_files[i:i + chunk])
+
+# Function to read one sidecar and pair it with its image
+# Returns (sidecar name, image name or None, file_mtime, pageid, None) or None if the sidecar has no usable timestamp
+def plan_sort(json_file, incoming_path):
+    with open(json_file, "r") as f:
+        meta = json.load(f) # Get the meta data from each json file being sorted
+    base_name = json_file.stem.replace(".meta", "")
+    return _plan(json_file, base_name, meta, incoming_path, json_file)
+
+# Function to pair one record of incoming/_metadata.jsonl with its image
+# Returns (None, image name, file_mtime, pageid, meta) or None if the record has no usable timestamp. The record is kept
+# in the plan, as it is written again into the bucket's store
+def plan_record(filename, meta, incoming_path):
+    return _plan(None, filename, meta, incoming_path, f"{STORE_NAME} record {filename}")
+
+# Helper function shared by both metadata formats: resolves the timestamp and finds the image in incoming/
+def _plan(sidecar, base_name, meta, incoming_path, source):
+    # Extract canonical timestamp from metadata
+    file_mtime = canonical_mtime(meta)
+    if file_mtime is None: # Sidecars written before canonical_timestamp existed still carry the raw strings
         raw_ts = meta.get("extmetadata", {}).get("DateTimeOriginal") or meta.get("upload_timestamp")
-        logging.info(f"raw timestamp {raw_ts} gathered")
+        logging.debug("raw timestamp %r gathered", raw_ts)
         if not raw_ts:
-            logging.warning(f"No timestamp in {json_file}, skipping")
-            continue
+            logging.warning("No timestamp in %s, skipping", source)
+            return None
         file_mtime = parse_fallback_datetime(raw_ts)  # robust time parsing using helper function
-        logging.info(f"Helper function used for robust timeparsing to get file mtime {file_mtime}")
+        logging.debug("Helper function used for robust timeparsing to get file mtime %s", file_mtime)
         if not file_mtime:
-            logging.warning(f"Could not parse timestamp {raw_ts} in {json_file}, skipping")
-            continue
-        # Build base name to find matching image
-        base_name = json_file.stem.replace(".meta", "")
-        image_extensions = [".jpg", ".jpeg", ".png"]
-        images = [incoming_path / (base_name) for ext in image_extensions if (incoming_path / (base_name)).exists() and (incoming_path / (base_name)).suffix == ext]
-        # Combine JSON + images for pairing
-        files_to_sort = [json_file] + images
-        # Sort all files (JSON + images) with same timestamp
-        logging.debug(".json files paired with matching image to prep for moving in sort")
-        for f in files_to_sort:
-            sort_files(f, args, file_mtime)
-        logging.info(f"{args.mode} performed on {len(files_to_sort)} files")
+            logging.warning("Could not parse timestamp %r in %s, skipping", raw_ts, source)
+            return None
+        file_mtime = canonical_mtime({"canonical_timestamp": to_utc_iso(file_mtime)}) # In UTC, the day newer sidecars are bucketed by
+    # Find the matching image
+    image = incoming_path / base_name
+    images = [image] if image.suffix in IMAGE_EXTENSIONS and image.exists() else []
+    if sidecar is None and not images: # A record is only moved along with its image
+        logging.debug("No image in %s for %s, leaving it in place", incoming_path, source)
+        return None
+    logging.debug("Metadata paired with matching image to prep for moving in sort")
+    # Names rather than paths, so a plan stays small however many files are waiting
+    return sidecar and sidecar.name, images[0].name if images else None, file_mtime, meta.get("pageid"), None if sidecar else meta
+
+# Function to sort every planned pair of one bucket, in order. Returns (files sorted, bytes sorted)
+# The image goes first and its metadata follows the name the image ended up with in the bucket
+def sort_bucket(plans, args, incoming_path):
+    files_done = 0
+    bytes_done = 0
+    for sidecar_name, image_name, file_mtime, pageid, record in plans:
+        sidecar = incoming_path / sidecar_name if sidecar_name else None
+        images = [incoming_path / image_name] if image_name else []
+        follow = None # Bucket path of an image that was a duplicate or got a new name, for its metadata to follow
+        for image in images:
+            size = os.path.getsize(image)
+            placed, duplicate = place_file(image, args, file_mtime)
+            if placed:
+                files_done += 1
+                bytes_done += 0 if duplicate else size # Nothing was written for content already in the bucket
+                update_location(pageid, placed) # Lets the next fetch see the file is already in its bucket
+                if duplicate or os.path.basename(placed) != image.name:
+                    follow = placed
+                if sidecar is None: # The record follows its image, under the name the image got in the bucket
+                    place_record(placed, record, args)
+            if sidecar is None and not os.path.exists(image):
+                remove_record(incoming_path, image.name) # The image left incoming/, so its record goes with it
+        if sidecar:
+            size = os.path.getsize(sidecar)
+            placed = place_sidecar(sidecar, follow, args, file_mtime) if follow else place_file(sidecar, args, file_mtime)[0]
+            if placed:
+                files_done += 1
+                bytes_done += size
+        logging.debug("%s performed on %d files", args.mode, len(images) + bool(sidecar))
+    return files_done, bytes_done
+
+# Function to give a sidecar the name of the bucket file its image ended up as (a duplicate's survivor, name_N.jpg)
+# If that file already has a sidecar it keeps its own metadata and this one is dropped. Returns the sidecar's bucket
+# path, or None if it was dropped
+def place_sidecar(sidecar, placed_image, args, file_mtime):
+    target = str(sidecar_path(placed_image))
+    if os.path.exists(target):
+        logging.log(FILE, "%s already has its metadata in %s, dropping %s", placed_image, target, sidecar.name)
+        if args.mode == "move":
+            os.remove(sidecar)
+        return None
+    if args.mode == "move":
+        shutil.move(sidecar, target)
+    else: # Sidecars are small, so the link modes just copy them
+        shutil.copy2(sidecar, target)
+    ts = file_mtime.replace(tzinfo=timezone.utc).timestamp()
+    os.utime(target, (ts, ts))
+    _note_placed(os.path.dirname(target), target)
+    logging.log(FILE, "%s placed as %s to match its image", sidecar.name, target)
+    return target
+
+# Function to write the record of a sorted image into its bucket's _metadata.jsonl
+# When the collision policy kept the bucket's existing file (keepold, dedupe, dedupelink), its record is kept too
+def place_record(placed, meta, args):
+    new_dir_path, name = os.path.split(placed)
+    names = _store_names.get(new_dir_path)
+    if names is None:
+        names = _store_names[new_dir_path] = set(read_store(new_dir_path))
+    if name in names and _move_type(args) in ("keepold", "dedupe", "dedupelink"):
+        logging.log(FILE, "%s keeps its own record in %s, the incoming one is dropped", name, STORE_NAME)
+        return
+    append_record(new_dir_path, name, meta)
+    names.add(name)
+
+# Function to build the bucket directory (<dest>/buckets/<year>/<month>/<day>) for a timestamp
+def bucket_dir(args, file_mtime):
+    return os.path.join(cwd, args.dest, f"buckets/{file_mtime.year}/{file_mtime.strftime('%m')}/{file_mtime.day}")
+
+# Function to read the UTC timestamp save_files_and_data already normalised into the sidecar. Returns None if absent
+def canonical_mtime(meta):
+    canonical = meta.get("canonical_timestamp")
+    if not canonical:
+        return None
+    try:
+        return datetime.fromisoformat(canonical.replace("Z", "+00:00"))
+    except ValueError:
+        logging.warning("Unreadable canonical timestamp %s, parsing the raw timestamp instead", canonical)
+        return None
+
+# Function to place one file in its bucket. Under dedupe/dedupelink identical content already in the bucket is
+# settled first without writing anything. Returns (bucket path or None, whether it was such a duplicate)
+def place_file(file, args, file_mtime):
+    if _move_type(args) in ("dedupe", "dedupelink"):
+        file_path = os.path.abspath(file)
+        new_dir_path = bucket_dir(args, file_mtime)
+        duplicate = find_duplicate(file_path, new_dir_path)
+        if duplicate: # Identical bytes are already in this bucket, so there is nothing to copy or move
+            return resolve_duplicate(file_path, duplicate, os.path.join(new_dir_path, os.path.basename(file)), args), True
+    return sort_files(file, args, file_mtime), False
 
 # Function to determine if the file should be moved or copied and calls the appropriate helper function
+# Returns the path the file ended up at in its bucket, or None if it is not in the bucket
 def sort_files(file, args, file_mtime):
     file_path = os.path.abspath(file)
-    PROJECT_path = os.path.join(cwd, args.dest)
     filename = os.path.basename(file)
-    new_dir_path = os.path.join(PROJECT_path, f"buckets/{file_mtime.year}/{file_mtime.strftime('%m')}/{file_mtime.day}")
+    new_dir_path = bucket_dir(args, file_mtime)
     new_file_path = os.path.join(new_dir_path, filename)
-    logging.info(f"new filepath {new_file_path} created for {file}")
+    logging.debug("new filepath %s created for %s", new_file_path, file)
     try:
         new_file_path = sorter_function(file_path, new_dir_path, new_file_path, args)
         if args.mode == "move":
-            if args.moveType.lower().strip() == "keepold":
-                logging.info(f"Skipping move for {file_path.name} (keepold modeType)")
-                return # Skips the move if keepold is passed
+            if _move_type(args) == "keepold":
+                logging.log(FILE, "Skipping move for %s (keepold modeType)", filename) # The bucket's copy stays
             else:
                 shutil.move(file_path, new_file_path) # Moves the file to its new location
-                logging.info(f"{filename} successfully moved from {file_path} to {new_file_path}")
+                logging.log(FILE, "%s successfully moved from %s to %s", filename, file_path, new_file_path)
         elif args.mode == "copy":
             shutil.copy2(file_path, str(new_file_path)) # Copies the file to its new location
-            logging.info(f"{filename} successfully copied from {file_path} to {new_file_path}")
+            logging.log(FILE, "%s successfully copied from %s to %s", filename, file_path, new_file_path)
+        elif args.mode in ("hardlink", "reflink"):
+            used = link_or_clone(file_path, str(new_file_path), args.mode) # Places the file without copying its bytes where possible
+            logging.log(FILE, "%s successfully placed (%s) from %s to %s", filename, used, file_path, new_file_path)
     except Exception as e:
-        logging.warning(f"Error sorting {file_path}: {e}")
-    finally:
-        if os.path.exists(new_file_path):
-            ts = file_mtime.replace(tzinfo=timezone.utc).timestamp() 
-            os.utime(new_file_path, (ts, ts)) # Sets the mtime of the file after moving to ensure mtime consistency
-            logging.info(f"Set UTC mtime of {filename} to {to_utc_iso(file_mtime)}")
-        else:
-            logging.warning(f"File {new_file_path} does not exist to have mtime reset")
+        logging.warning("Error sorting %s: %s", file_path, e)
+    if os.path.exists(new_file_path):
+        ts = file_mtime.replace(tzinfo=timezone.utc).timestamp()
+        os.utime(new_file_path, (ts, ts)) # Sets the mtime of the file after moving to ensure mtime consistency
+        _note_placed(new_dir_path, new_file_path)
+        logging.debug("Set UTC mtime of %s to %s", filename, file_mtime)
+        return new_file_path
+    logging.warning("File %s does not exist to have mtime reset", new_file_path)
+    return None
     
 def sorter_function(file, new_dir_path, new_file_path, args):
     filename = os.path.basename(file)
     base, ext = os.path.splitext(filename)
-    counter = 1
     file_path = os.path.abspath(file)
     if not os.path.exists(new_dir_path):
         os.makedirs(new_dir_path, exist_ok=True)
-        logging.info(f"new directory {new_dir_path} created. ")
+        logging.debug("new directory %s created. ", new_dir_path)
     if os.path.exists(new_file_path):
         if not args.moveType:
-            keep=input(f"Would you like to keep both copies of {new_file_path.name}? If no, the newly saved file will be deleted. \n if replace, the new file will replace the old file: 'y' or 'n' or 'r': \n ")
-        if args.moveType.lower().strip() == "keepboth":
+            keep=input(f"Would you like to keep both copies of {filename}? If no, the newly saved file will be deleted. \n if replace, the new file will replace the old file: 'y' or 'n' or 'r': \n ")
+        if _move_type(args) in ("keepboth", "dedupe", "dedupelink"): # Different bytes under the same name are kept side by side
             keep = "y" 
-        if args.moveType.lower().strip() == "keepnew":
+        if _move_type(args) == "keepnew":
             keep = "r"
-        if args.moveType.lower().strip() == "keepold":
+        if _move_type(args) == "keepold":
             keep = "n"
         if keep.lower() == "n":
             os.remove(file_path) # Deletes the new file if user did not want to keep both copies
-            logging.info(f"User does not want both copies. New file deleted from origin. ")
+            logging.log(FILE, "User does not want both copies. New file deleted from origin. ")
             return new_file_path
         elif keep.lower() == "r":
             os.remove(new_file_path) # Removes the file the user wants to replace to prep for moving the new file to its spot
-            logging.info(f"Existing file {new_file_path.name} will be removed")
+            _file_hashes.pop(new_file_path, None)
+            logging.log(FILE, "Existing file %s will be removed", filename)
             return new_file_path
         elif keep.lower() == "y":
-            candidate_path=new_file_path
-            while os.path.exists(candidate_path): # Loops to continue incrementing the name hash if multiple collisions are found
-                candidate_path = os.path.join(new_dir_path, f"{base}_{counter}{ext}") # Renames colliding file
-                counter +=1 # Increments counter to continue avoiding name collisions if repeat name collisions occur
-                logging.info(f"File {new_file_path} already exists. Name hash added to file. Kept as {candidate_path}")
+            candidate_path = free_suffix_path(new_dir_path, base, ext)
+            logging.log(FILE, "File %s already exists. Name hash added to file. Kept as %s", new_file_path, candidate_path)
             return candidate_path
     return new_file_path
+
+
+# Function to place a file in its bucket without rewriting its bytes: a hardlink, or a copy-on-write clone (reflink)
+# Falls back to a regular copy when source and bucket are on different devices or the filesystem can't do it
+# Returns which method was actually used
+def link_or_clone(file_path, new_file_path, mode):
+    device = os.stat(file_path).st_dev
+    if device != os.stat(os.path.dirname(new_file_path)).st_dev:
+        logging.log(FILE, "%s is on a different device than its bucket, copying instead of %s", file_path, mode)
+        shutil.copy2(file_path, new_file_path)
+        return "copy"
+    if mode == "reflink" and device in _no_reflink_devices:
+        shutil.copy2(file_path, new_file_path)
+        return "copy"
+    try:
+        if mode == "hardlink":
+            os.link(file_path, new_file_path)
+        else:
+            _reflink(file_path, new_file_path)
+        return mode
+    except OSError as e:
+        if e.errno not in LINK_FALLBACK_ERRORS:
+            raise
+        if mode == "reflink":
+            _no_reflink_devices.add(device)
+        logging.info("%s not supported for %s (%s), copying instead", mode, file_path, e)
+        shutil.copy2(file_path, new_file_path)
+        return "copy"
+
+
+# Function to clone a file with the FICLONE ioctl, keeping its metadata like copy2 does
+def _reflink(file_path, new_file_path):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflink needs fcntl (Linux)")
+    with open(file_path, "rb") as src, open(new_file_path, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(new_file_path) # Don't leave an empty file behind for the copy fallback to trip over
+            raise
+    shutil.copystat(file_path, new_file_path)
+
+
+# Function to read the collision policy from the CLI arguments in a consistent form
+def _move_type(args):
+    return (args.moveType or "").lower().strip()
+
+
+# Function to pick the next free name_N.ext in a bucket without probing the disk once per candidate
+# The bucket is listed once; the first collision of a name looks for the highest base_N.ext already there (only that
+# exact base, so IMG_2014.jpg gets IMG_2014_1.jpg, not IMG_2015.jpg), and later ones count up in memory
+def free_suffix_path(new_dir_path, base, ext):
+    listing = _next_suffix.get(new_dir_path)
+    if listing is None:
+        listing = _next_suffix[new_dir_path] = (os.listdir(new_dir_path), {})
+    names, suffixes = listing
+    counter = suffixes.get((base, ext))
+    if counter is None:
+        pattern = re.compile(re.escape(base) + r"_(\d+)" + re.escape(ext))
+        counter = max([int(match.group(1)) + 1 for match in map(pattern.fullmatch, names) if match], default=1)
+    candidate_path = os.path.join(new_dir_path, f"{base}_{counter}{ext}")
+    while os.path.exists(candidate_path): # Only loops if something outside this run created the name since the listdir
+        counter += 1
+        candidate_path = os.path.join(new_dir_path, f"{base}_{counter}{ext}")
+    suffixes[(base, ext)] = counter + 1
+    return candidate_path
+
+
+# Function to hash a file in fixed-size chunks (sha1, the same digest Commons reports), memoised per path
+def file_sha1(path):
+    digest = _file_hashes.get(path)
+    if digest is None:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            while chunk := f.read(HASH_CHUNK):
+                sha1.update(chunk)
+        digest = _file_hashes[path] = sha1.hexdigest()
+    return digest
+
+
+# Function to find a file in the bucket with exactly the same bytes as file_path. Returns its path or None
+# Only files of the same size are hashed, and each bucket is listed once per run
+def find_duplicate(file_path, new_dir_path):
+    sizes = _bucket_sizes.get(new_dir_path)
+    if sizes is None:
+        sizes = _bucket_sizes[new_dir_path] = {}
+        if os.path.isdir(new_dir_path):
+            with os.scandir(new_dir_path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        sizes.setdefault(entry.stat().st_size, []).append(entry.path)
+    candidates = sizes.get(os.path.getsize(file_path))
+    if not candidates:
+        return None
+    digest = file_sha1(file_path)
+    for candidate in candidates:
+        if os.path.exists(candidate) and file_sha1(candidate) == digest:
+            return candidate
+    return None
+
+
+# Function to settle an identical-content collision without writing any bytes
+# dedupelink hardlinks the incoming name to the existing copy when that name is free; otherwise it is a no-op.
+# In move mode the incoming duplicate is removed. Returns the bucket path that now holds the content
+def resolve_duplicate(file_path, duplicate, new_file_path, args):
+    placed = duplicate
+    linked = False
+    if _move_type(args) == "dedupelink" and not os.path.exists(new_file_path):
+        try:
+            os.link(duplicate, new_file_path)
+            linked = True
+        except OSError as e:
+            if e.errno not in LINK_FALLBACK_ERRORS:
+                raise
+            logging.info("Could not hardlink %s to %s (%s), keeping only the existing copy", new_file_path, duplicate, e)
+    if linked:
+        placed = new_file_path
+        _note_placed(os.path.dirname(new_file_path), new_file_path)
+        logging.log(FILE, "%s is identical to %s, hardlinked as %s", os.path.basename(file_path), duplicate, new_file_path)
+    else:
+        logging.log(FILE, "%s is identical to %s, nothing to %s", os.path.basename(file_path), duplicate, args.mode)
+    if args.mode == "move":
+        os.remove(file_path)
+    return placed
+
+
+# Function to keep the in-memory bucket listings (and the report index) current after a file lands in a bucket
+def _note_placed(new_dir_path, new_file_path):
+    mark_dirty(new_dir_path)
+    sizes = _bucket_sizes.get(new_dir_path)
+    if sizes is not None:
+        paths = sizes.setdefault(os.path.getsize(new_file_path), [])
+        if new_file_path not in paths:
+            paths.append(new_file_path)
+    _file_hashes.pop(new_file_path, None) # The content at this path may have just changed
     
 if __name__ == "__main__":
     logging.debug(f"Initiate an args object for debugging running only this file")
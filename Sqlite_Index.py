@@ -0,0 +1,41 @@
+import sqlite3
+import threading
+from pathlib import Path
+
+# Shared plumbing of the SQLite indexes (Download_Index, Report_Index): one WAL-mode connection per database, shared
+# by every worker thread and serialised by a lock, opened per destination folder and closed at the end of a run
+
+
+# One connection to an index database with its schema. Callers hold .lock around every use of .conn
+class SharedConnection:
+    def __init__(self, schema):
+        self.schema = schema
+        self.lock = threading.Lock()
+        self.conn = None
+        self.path = None
+
+    # Opens (or creates) the database at path, closing one opened at another path first
+    # Returns False when path is already the open database, True when it was (re)opened
+    def open(self, path):
+        path = Path(path).resolve()
+        with self.lock:
+            if self.conn is not None and self.path == path:
+                return False
+            if self.conn is not None:
+                self.conn.close()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL") # Readers never block the writer, and commits stay cheap
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(self.schema)
+            self.conn.commit()
+            self.path = path
+        return True
+
+    # Closes the database. Safe to call when it was never opened
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            self.path = None
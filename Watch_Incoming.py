@@ -0,0 +1,300 @@
+import os
+import json
+import time
+import select
+import signal
+import struct
+import ctypes
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import Metrics
+from Sort_Files import file_to_sort, plan_sort, plan_record, sort_bucket, bucket_dir, IMAGE_EXTENSIONS
+from Download_Index import open_index
+from Report_Index import open_report_index
+from Metadata_Store import STORE_NAME
+
+# `organize --watch`: a long-running organize that sorts files as they land in <dest>/incoming/.
+# Each image is paired with its metadata (a .meta.json sidecar or a _metadata.jsonl record). Download_Files writes
+# the metadata last, so once both have arrived the download is finished. When neither has changed for SETTLE_SECONDS
+# the pair goes through the same plan_sort/sort_bucket path as a normal organize. Pairs that settle together are
+# sorted as one batch. Only the names the events report are looked at, never the whole folder, and the process sleeps
+# in select() between bursts.
+# Uses Linux inotify through ctypes; elsewhere, or with --poll (e.g. network storage, where inotify misses remote
+# writes), a folder listing every --poll-interval seconds takes its place
+# A pair still missing its image or metadata after STALE_SETTLES settle windows is given up on (a .JPG image, a file
+# the fetch skipped...) and left in incoming/ for the next organize. A batch that fails is logged and left there too
+SETTLE_SECONDS = 1.0
+STALE_SETTLES = 60
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct("iIII") # struct inotify_event without its name: wd, mask, cookie, len
+META_SUFFIX = ".meta.json"
+
+
+# Watches a folder with inotify. read() returns (names closed after writing or moved in, changed store names, overflowed)
+class InotifyWatch:
+    def __init__(self, path):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_MODIFY) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch failed for {path}")
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        names, changed, overflow = [], set(), False
+        if not ready:
+            return names, changed, overflow
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0"))
+                offset += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW: # The kernel queue filled up and events were lost
+                    overflow = True
+                elif name == STORE_NAME:
+                    changed.add(name)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    names.append(name)
+        return names, changed, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Polling stand-in for InotifyWatch. A file counts as closed once its size and mtime are the same on two polls in a row
+class PollingWatch:
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.files = {} # name -> ((size, mtime_ns), reported)
+        for name, key in self._list():
+            self.files[name] = (key, True) # Whatever is there now is left to the catch-up organize
+
+    def _list(self):
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    yield entry.name, (stat.st_size, stat.st_mtime_ns)
+
+    def read(self, timeout):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        names, changed = [], set()
+        files = {}
+        for name, key in self._list():
+            previous = self.files.get(name)
+            if name == STORE_NAME:
+                if previous is None or previous[0] != key:
+                    changed.add(name)
+                files[name] = (key, True)
+            elif previous is not None and previous[0] == key:
+                if not previous[1]:
+                    names.append(name)
+                files[name] = (key, True)
+            else:
+                files[name] = (key, False)
+        self.files = files
+        return names, changed, False
+
+    def close(self):
+        pass
+
+
+# Function to open the best watcher available for a folder
+def open_watch(path, poll=False, poll_interval=2.0):
+    if not poll:
+        try:
+            watch = InotifyWatch(path)
+            logging.info(f"Watching {path} with inotify")
+            return watch
+        except (OSError, AttributeError) as e: # AttributeError: no inotify in this libc (not Linux)
+            logging.warning(f"inotify is not available ({e}), polling {path} every {poll_interval}s instead")
+    else:
+        logging.info(f"Polling {path} every {poll_interval}s")
+    return PollingWatch(path, poll_interval)
+
+
+# Follows the appends to incoming/_metadata.jsonl, so records are picked up without re-reading the whole store
+class StoreTail:
+    def __init__(self, folder):
+        self.path = os.path.join(folder, STORE_NAME)
+        self.inode = None
+        self.offset = 0
+        self.partial = b""
+        self.skip() # Records already there are left to the catch-up organize
+
+    def skip(self):
+        try:
+            stat = os.stat(self.path)
+            self.inode, self.offset = stat.st_ino, stat.st_size
+        except FileNotFoundError:
+            self.inode, self.offset = None, 0
+        self.partial = b""
+
+    # Returns the (filename, meta or None for a removal) records appended since the last call
+    def read(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.inode, self.offset, self.partial = None, 0, b""
+            return []
+        if stat.st_ino != self.inode or stat.st_size < self.offset: # Compacted or replaced, read it from the top
+            self.inode, self.offset, self.partial = stat.st_ino, 0, b""
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = self.partial + f.read()
+            self.offset = f.tell()
+        *lines, self.partial = data.split(b"\n") # The last piece is an unfinished line (or empty)
+        records = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning("Ignoring an unreadable line in %s", self.path)
+                continue
+            records.append((record["filename"], None if record.get("deleted") else record["meta"]))
+        return records
+
+
+# Helper function to tell which pending pair a file name belongs to: (base image name, "image" or "meta"), or None
+def _classify(name):
+    if name.endswith(META_SUFFIX):
+        return Path(name).stem.replace(".meta", ""), "meta" # The same pairing rule as plan_sort
+    if Path(name).suffix in IMAGE_EXTENSIONS:
+        return name, "image"
+    return None
+
+
+# Helper function for whether a pending pair is complete: its metadata arrived, and its image too when it has one
+def _complete(base, entry):
+    has_meta = "meta" in entry or "record" in entry
+    return has_meta and ("image" in entry or Path(base).suffix not in IMAGE_EXTENSIONS)
+
+
+# Helper function for when the last part of a pending pair arrived (monotonic seconds)
+def _arrived(entry):
+    return max(entry[part] for part in ("image", "meta") if part in entry)
+
+
+# Function to sort a batch of settled pairs through the normal organize path. Returns (files sorted, bytes sorted)
+def sort_ready(ready, args, incoming_path, workers):
+    open_index(args.dest)
+    open_report_index(args.dest) # Every batch: refreshing the reports after the last one closed it
+    plans = []
+    for base, entry in ready:
+        try:
+            if "record" in entry:
+                plan = plan_record(base, entry["record"], incoming_path)
+            else:
+                json_file = incoming_path / entry["sidecar"]
+                if not json_file.exists(): # Already sorted (by the catch-up pass or an earlier event)
+                    continue
+                plan = plan_sort(json_file, incoming_path)
+        except (OSError, ValueError) as e: # An unreadable sidecar stays in incoming/ for the next organize
+            logging.error("Could not read the metadata of %s, leaving it in place: %s", base, e)
+            continue
+        if plan:
+            plans.append(plan)
+    buckets = {}
+    for plan in plans:
+        buckets.setdefault(bucket_dir(args, plan[2]), []).append(plan)
+    for new_dir_path in buckets:
+        os.makedirs(new_dir_path, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sort") as pool:
+        results = list(pool.map(lambda plans: sort_bucket(plans, args, incoming_path), buckets.values()))
+    return sum(count for count, _ in results), sum(size for _, size in results)
+
+
+# Helper function so SIGTERM (systemd, docker stop...) stops the watch as cleanly as Ctrl-C
+def _stop_on_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
+
+# Function for organize --watch: sorts what is already in incoming/, then every new pair as it lands, until Ctrl-C
+# or SIGTERM. on_batch is called after each batch (used to refresh the reports)
+def watch_incoming(args, on_batch=None):
+    incoming_path = Path(os.getcwd()) / args.dest / "incoming"
+    incoming_path.mkdir(parents=True, exist_ok=True)
+    workers = max(1, getattr(args, "workers", 1) or 1)
+    settle = getattr(args, "settle", None) or SETTLE_SECONDS
+    watch = open_watch(incoming_path, getattr(args, "poll", False), getattr(args, "poll_interval", 2.0))
+    tail = StoreTail(incoming_path)
+    pending = {} # base image name -> {"image": arrival, "meta": arrival, "sidecar": name, "record": meta}
+    previous_handler = signal.signal(signal.SIGTERM, _stop_on_sigterm)
+    try:
+        file_to_sort(args, compact_incoming=False) # Catch up on everything that arrived while nothing was watching (the watch is already on)
+        if on_batch:
+            on_batch()
+        logging.info(f"Watching {incoming_path} for new files, Ctrl-C to stop")
+        overflow = False
+        while True:
+            now = time.monotonic()
+            waits = [_arrived(entry) + (settle if _complete(base, entry) else settle * STALE_SETTLES) - now
+                     for base, entry in pending.items()]
+            names, changed, overflow = watch.read(max(0.0, min(waits)) if waits else None)
+            now = time.monotonic()
+            if overflow: # Events were lost, so look at the whole folder once to find what they were about
+                logging.warning(f"inotify queue overflowed, rescanning {incoming_path}")
+                names = os.listdir(incoming_path)
+                tail.inode = None # Reads the store again from the top
+                changed.add(STORE_NAME)
+            for name in names:
+                kind = _classify(name)
+                if kind is None:
+                    continue
+                base, part = kind
+                entry = pending.setdefault(base, {})
+                entry[part] = now
+                if part == "meta":
+                    entry["sidecar"] = name
+            if changed:
+                for filename, meta in tail.read():
+                    if meta is None: # Our own removal after sorting it, or a file fetched again
+                        continue
+                    entry = pending.setdefault(filename, {})
+                    entry["record"] = meta
+                    entry["meta"] = now
+            for base, entry in list(pending.items()):
+                if not _complete(base, entry) and _arrived(entry) + settle * STALE_SETTLES <= now:
+                    del pending[base]
+                    missing = "metadata" if "image" in entry else "image"
+                    logging.warning("Gave up waiting for the %s of %s, leaving it in %s for the next organize", missing, base, incoming_path)
+            ready = [(base, entry) for base, entry in pending.items()
+                     if _complete(base, entry) and _arrived(entry) + settle <= now]
+            if not ready:
+                continue
+            for base, _ in ready:
+                del pending[base]
+            started = time.perf_counter()
+            try:
+                files_done, bytes_done = sort_ready(ready, args, incoming_path, workers)
+            except Exception as e: # One bad batch must not end the watch, its files stay in incoming/
+                logging.exception("Sorting a batch of %d new arrivals failed, leaving them for the next organize: %s", len(ready), e)
+                continue
+            elapsed = time.perf_counter() - started
+            Metrics.add_files("sort", files_done, bytes_done)
+            for base, entry in ready: # Time from the pair being complete to it being in its bucket
+                Metrics.record_latency("watch", time.monotonic() - _arrived(entry))
+            logging.info(f"Sorted {files_done} files ({bytes_done / 1024**2:.2f}MB) from {len(ready)} new arrivals in {elapsed:.2f}s, "
+                         f"{len(pending)} still waiting for their pair")
+            if on_batch:
+                on_batch()
+    except KeyboardInterrupt:
+        logging.info(f"Watch stopped, {len(pending)} incomplete pairs left in {incoming_path} for the next organize")
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        watch.close()
@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import glob
+import time
+import signal
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import urllib.request
+
+# End-to-end benchmark of fetch -> organize -> report against the local stand-in API (bench/fake_commons.py).
+# For every size it starts a fresh server and destination, runs the three commands as separate processes and records
+# wall time, peak RSS and request counts (from the server and from each command's metrics.json) into a JSON baseline.
+# With --compare it prints how a run differs from an earlier baseline. --scenarios adds end-to-end checks that fail
+# loudly instead of timing: "watch" runs organize --watch next to a jsonl fetch and checks nothing is left behind,
+# "resume" kills a fetch mid-download and checks `fetch --resume` finishes every file from its .part
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_SIZES = [1000, 10000, 100000]
+sys.path.insert(0, REPO_DIR)
+from Metadata_Store import read_store
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.load(response)
+
+
+def wait_for_server(port, process):
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError("fake_commons.py exited before it started serving")
+        try:
+            return server_stats(port)
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("fake_commons.py did not start")
+
+
+# Runs one daybuckets command and returns its wall time, peak RSS and the metrics.json it wrote
+def run_command(command, dest, env, workdir):
+    started = time.perf_counter()
+    process = subprocess.Popen(daybuckets(*command, "--dest", dest),
+                               cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, status, usage = os.wait4(process.pid, 0) # Per-process rusage, so each command's peak RSS is its own
+    elapsed = time.perf_counter() - started
+    stderr = process.stderr.read().decode(errors="replace")
+    process.stderr.close()
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"{' '.join(command)} failed:\n{stderr}")
+    metrics_path = os.path.join(workdir, dest, "reports", "metrics.json")
+    with open(metrics_path, encoding="utf-8") as f:
+        metrics = json.load(f)
+    return {
+        "wall_seconds": round(elapsed, 3),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1), # ru_maxrss is in KiB on Linux
+        "http_requests": metrics.get("http", {}).get("requests", 0),
+        "api_calls": metrics.get("api_calls", {}),
+        "stages": metrics.get("stages", {}),
+        "latency": metrics.get("latency", {}),
+        "counters": metrics.get("counters", {}),
+    }
+
+
+# Starts a fake_commons.py server for a number of files, on a free port unless one is given. Returns (port, process)
+def start_server(files, args, *extra, port=None):
+    port = port or free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_commons.py"), "--port", str(port), "--files", str(files),
+                               "--min-size", str(args.min_size), "--max-size", str(args.max_size), *extra],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_server(port, server)
+    return port, server
+
+
+def daybuckets(*command):
+    return [sys.executable, os.path.join(REPO_DIR, "daybuckets.py"), *command]
+
+
+def bench_size(files, args):
+    port, server = start_server(files, args)
+    workdir = tempfile.mkdtemp(prefix="daybuckets-pipeline-")
+    env = dict(os.environ, DAYBUCKETS_API=f"http://127.0.0.1:{port}/w/api.php")
+    workers = ["--workers", str(args.workers)]
+    result = {"files": files}
+    try:
+        commands = {
+            "fetch": ["fetch", "--category", "Bench_0", "--rate", "0", "--no-cache", "--fetch-path", args.fetch_path, *workers],
+            "organize": ["organize", "--mode", "move", "--moveType", "keepboth", *workers],
+            "report": ["report", "--md", "--json", "--json-format", "compact", *workers],
+        }
+        for name, command in commands.items():
+            before = server_stats(port)
+            result[name] = run_command(command, "P", env, workdir)
+            after = server_stats(port)
+            result[name]["server_requests"] = {key: after.get(key, 0) - before.get(key, 0) for key in ("api", "files")}
+            print(f"{files:>7} files  {name:<8} {result[name]['wall_seconds']:>8.2f}s  peak {result[name]['peak_rss_mb']:>7.1f}MB  "
+                  f"requests {result[name]['server_requests']}", flush=True)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+# Scenario: a rate-limited jsonl fetch with organize --watch joining once the first files have landed, so the watch's
+# catch-up pass runs while the fetch is still appending to incoming/_metadata.jsonl. Every image must end up in a
+# bucket with its record. Returns the counts and the watch latency, raises if anything was left behind
+def bench_watch(files, args):
+    port, server = start_server(files, args)
+    workdir = tempfile.mkdtemp(prefix="daybuckets-watch-")
+    env = dict(os.environ, DAYBUCKETS_API=f"http://127.0.0.1:{port}/w/api.php")
+    incoming = os.path.join(workdir, "P", "incoming")
+    watch = None
+    try:
+        started = time.perf_counter()
+        fetch = subprocess.Popen(daybuckets("fetch", "--category", "Bench_0", "--dest", "P", "--no-cache", "--rate", "200",
+                                            "--workers", str(args.workers), "--metadata-store", "jsonl"),
+                                 cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        while fetch.poll() is None and len(glob.glob(os.path.join(incoming, "*.jpg"))) < 20:
+            time.sleep(0.05)
+        watch = subprocess.Popen(daybuckets("organize", "--dest", "P", "--mode", "move", "--moveType", "keepboth", "--watch",
+                                            "--workers", str(args.workers)),
+                                 cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if fetch.wait() != 0:
+            raise RuntimeError("fetch failed during the watch scenario")
+        time.sleep(3) # Several settle windows, for the last pairs
+        watch.send_signal(signal.SIGTERM)
+        _, stderr = watch.communicate()
+        if watch.returncode != 0:
+            raise RuntimeError(f"organize --watch failed:\n{stderr.decode(errors='replace')}")
+        elapsed = time.perf_counter() - started
+        left = [name for name in os.listdir(incoming) if name.endswith(".jpg")]
+        records = read_store(incoming)
+        sorted_files = glob.glob(os.path.join(workdir, "P", "buckets", "*", "*", "*", "*.jpg"))
+        with open(os.path.join(workdir, "P", "reports", "metrics.json"), encoding="utf-8") as f:
+            latency = json.load(f).get("latency", {}).get("watch", {})
+        result = {"files": files, "sorted": len(sorted_files), "left_in_incoming": len(left), "live_incoming_records": len(records),
+                  "wall_seconds": round(elapsed, 3), "latency": latency}
+        print(f"{files:>7} files  watch    {elapsed:>8.2f}s  sorted {len(sorted_files)}  left {len(left)}  records left {len(records)}", flush=True)
+        if left or records:
+            raise RuntimeError(f"organize --watch left {len(left)} images and {len(records)} records in incoming/")
+        return result
+    finally:
+        if watch is not None and watch.poll() is None:
+            watch.kill()
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Helper function for the sizes of the non-empty .part files in a folder (an empty one has nothing to resume)
+def partial_downloads(folder):
+    parts = {}
+    for path in glob.glob(os.path.join(folder, "*.part")):
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError: # Completed and renamed since the listing
+            continue
+        if size:
+            parts[path] = size
+    return parts
+
+
+# Scenario: a fetch of larger files from a server that cuts every 5th transfer off halfway, killed while a cut file
+# waits for its retry, then `fetch --resume` against a restarted server that cuts nothing, so every resume it counts
+# continues a .part the killed run left. Every file must arrive complete (the client checks each sha1) and nothing may
+# be downloaded again from the start. Returns the counts, raises on a failed check
+def bench_resume(files, args):
+    sizes = ("--min-size", "65536", "--max-size", "262144")
+    port, server = start_server(files, args, *sizes, "--drop-every", "5")
+    workdir = tempfile.mkdtemp(prefix="daybuckets-resume-")
+    env = dict(os.environ, DAYBUCKETS_API=f"http://127.0.0.1:{port}/w/api.php")
+    incoming = os.path.join(workdir, "P", "incoming")
+    try:
+        started = time.perf_counter()
+        fetch = subprocess.Popen(daybuckets("fetch", "--category", "Bench_0", "--dest", "P", "--no-cache", "--rate", "0",
+                                            "--workers", str(args.workers)),
+                                 cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        previous = {}
+        while fetch.poll() is None: # A .part that keeps its size between two polls is a cut transfer waiting for its retry
+            parts = partial_downloads(incoming)
+            if server_stats(port).get("dropped") and any(previous.get(path) == size for path, size in parts.items()):
+                break
+            previous = parts
+            time.sleep(0.02)
+        fetch.kill()
+        fetch.wait()
+        parts_left = partial_downloads(incoming)
+        server.terminate()
+        server.wait()
+        port, server = start_server(files, args, *sizes, port=port)
+        resumed = run_command(["fetch", "--resume", "--no-cache", "--rate", "0", "--workers", str(args.workers)], "P", env, workdir)
+        elapsed = time.perf_counter() - started
+        images = len(glob.glob(os.path.join(incoming, "*.jpg")))
+        # A .part killed between its last write and the rename already holds every byte, and is finished without a request
+        short_parts = sum(1 for path, size in parts_left.items() if size < os.path.getsize(path[:-len(".part")]))
+        expected = sum(1 for pageid in range(1, files + 1) if pageid % 97) # fake_commons' default --missing-every
+        counters = resumed["counters"]
+        stats = server_stats(port)
+        result = {"files": files, "images": images, "expected": expected, "parts_after_kill": len(parts_left), "short_parts": short_parts,
+                  "download_resumes": counters.get("download_resumes", 0), "download_restarts": counters.get("download_restarts", 0),
+                  "sha1_mismatches": counters.get("download_sha1_mismatches", 0), "server_ranged": stats.get("ranged", 0),
+                  "server_dropped": stats.get("dropped", 0), "wall_seconds": round(elapsed, 3)}
+        print(f"{files:>7} files  resume   {elapsed:>8.2f}s  images {images}/{expected}  .part after kill {len(parts_left)} ({short_parts} short)  "
+              f"resumes {result['download_resumes']}  ranged {result['server_ranged']}", flush=True)
+        if (images != expected or not short_parts or result["download_resumes"] < short_parts or result["download_restarts"]
+                or result["sha1_mismatches"]):
+            raise RuntimeError(f"fetch --resume check failed: {result}")
+        if glob.glob(os.path.join(incoming, "*.part")):
+            raise RuntimeError("fetch --resume left .part files behind")
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Function to print the change of every wall time and peak RSS against an earlier baseline
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {run["files"]: run for run in json.load(f)["runs"]}
+    for run in results:
+        old = baseline.get(run["files"])
+        if not old:
+            continue
+        for name in ("fetch", "organize", "report"):
+            if name in old:
+                for key, unit in (("wall_seconds", "s"), ("peak_rss_mb", "MB")):
+                    change = (run[name][key] - old[name][key]) / old[name][key] * 100 if old[name][key] else 0
+                    print(f"{run['files']:>7} files  {name:<8} {key:<12} {old[name][key]:>8.2f}{unit} -> {run[name][key]:>8.2f}{unit} ({change:+.1f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end fetch/organize/report benchmark against a local stand-in API")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Category sizes (files) to run")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--fetch-path", choices=["generator", "twostep"], default="generator")
+    parser.add_argument("--min-size", type=int, default=512, help="Smallest synthetic image in bytes")
+    parser.add_argument("--max-size", type=int, default=4096, help="Largest synthetic image in bytes")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "pipeline_baseline.json"), help="Where to write the results")
+    parser.add_argument("--compare", help="An earlier results file to compare against")
+    parser.add_argument("--scenarios", nargs="+", choices=["pipeline", "watch", "resume"], default=["pipeline"],
+                        help="pipeline times fetch/organize/report, watch checks organize --watch next to a running fetch, "
+                             "resume checks fetch --resume after a fetch killed mid-download")
+    args = parser.parse_args()
+    results = [bench_size(files, args) for files in args.sizes] if "pipeline" in args.scenarios else []
+    scenarios = {}
+    if "watch" in args.scenarios:
+        scenarios["watch"] = [bench_watch(files, args) for files in args.sizes]
+    if "resume" in args.scenarios:
+        scenarios["resume"] = [bench_resume(files, args) for files in args.sizes]
+    document = {
+        "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "workers": args.workers,
+        "fetch_path": args.fetch_path,
+        "runs": results,
+    }
+    if scenarios:
+        document["scenarios"] = scenarios
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=2)
+    print(f"Results saved to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
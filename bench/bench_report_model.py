@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # The pipeline modules live in the repo root
+from Report_Generate import DayStats, ns_to_datetime
+
+# Compares the old per-file report model (nested dicts of "%c" strings parsed back with strptime) with the
+# columnar DayStats model, on synthetic days so only the in-memory aggregation is measured, not the disk
+FILES = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+FILES_PER_DAY = 300
+START_NS = 1_600_000_000 * 10**9
+
+
+def synthetic_files():
+    for i in range(FILES):
+        yield f"{i // FILES_PER_DAY}", f"File_{i:08d}.jpg", 50_000 + i % 7919, START_NS + i * 1_234_567
+
+
+# The model as it was: name -> strftime("%c") per file, size kept as an "MB" string, strptime on every report
+def legacy_model():
+    tree = OrderedDict()
+    sizes = {}
+    for day, name, size, mtime_ns in synthetic_files():
+        tree.setdefault(day, OrderedDict())[name] = datetime.fromtimestamp(mtime_ns / 1e9).strftime("%c")
+        sizes[day] = sizes.get(day, 0) + size
+    for day, files in tree.items():
+        files["__dir_size__"] = f"{sizes[day] / 1024**2:.2f}MB"
+        files["__file_count__"] = len(files) - 1
+    for files in tree.values():
+        mtimes = [datetime.strptime(ts, "%c") for f, ts in files.items() if f not in ("__file_count__", "__dir_size__")]
+        min(mtimes), max(mtimes), float(files["__dir_size__"].replace("MB", "")) * 1024**2
+    return tree
+
+
+def columnar_model():
+    tree = OrderedDict()
+    for day, name, size, mtime_ns in synthetic_files():
+        stats = tree.get(day)
+        if stats is None:
+            stats = tree[day] = DayStats()
+        stats.add(name, size, mtime_ns)
+    for stats in tree.values():
+        count, total, earliest, latest = stats.summary()
+        ns_to_datetime(earliest), ns_to_datetime(latest)
+    return tree
+
+
+def measure(func):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    print(f"{FILES} synthetic files in {FILES // FILES_PER_DAY + 1} days")
+    legacy_time, legacy_peak = measure(legacy_model)
+    columnar_time, columnar_peak = measure(columnar_model)
+    print(f"legacy  : {legacy_time:.2f}s, peak {legacy_peak / 1024**2:.1f}MB")
+    print(f"columnar: {columnar_time:.2f}s, peak {columnar_peak / 1024**2:.1f}MB "
+          f"({legacy_time / columnar_time:.1f}x faster, {legacy_peak / columnar_peak:.1f}x less memory)")
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # The pipeline modules live in the repo root
+import Report_Generate
+
+# Times a full report scan of a synthetic buckets/<year>/<month>/<day> tree with the serial walk_days from before
+# report --workers existed, then with each --workers count (1 included), and checks every run writes byte-identical
+# reports. Speedups are relative to that serial walk. --latency-ms adds a sleep to every directory listing and
+# every stat, standing in for the round trips of network storage (a local disk answers from the page cache)
+
+
+def build_tree(root, years, files_per_day):
+    for year in range(2000, 2000 + years):
+        for month in range(1, 13):
+            for day in range(1, 29):
+                day_dir = root / "buckets" / str(year) / f"{month:02d}" / str(day)
+                day_dir.mkdir(parents=True, exist_ok=True)
+                for i in range(files_per_day):
+                    (day_dir / f"File_{i:03d}.jpg").write_bytes(b"x" * (i + 1))
+
+
+# Wraps scan_directory so every listing and every file stat costs latency seconds
+def add_latency(latency):
+    scan_directory = Report_Generate.scan_directory
+    def slow_scan(directory):
+        day, subdirs = scan_directory(directory)
+        time.sleep(latency * (1 + (len(day) if day is not None else 0)))
+        return day, subdirs
+    Report_Generate.scan_directory = slow_scan
+
+
+# The serial walk_days as it was before report --workers, kept verbatim as the baseline. It takes (and ignores) the
+# pool and scans arguments so bucket_days can call it unchanged
+def serial_walk_days(subdirs, parts=(), buckets=None, pool=None, scans=None):
+    days = []
+    folders = []
+    for subdir in subdirs:
+        if subdir.name in Report_Generate.SKIP_DIRS:
+            continue
+        if buckets is not None and not parts and subdir.name == "buckets":
+            folders.append((subdir.name, None))
+            continue
+        day, children = Report_Generate.scan_directory(subdir.path)
+        if day is not None:
+            days.append((subdir.name, day))
+        else:
+            folders.append((subdir.name, children))
+    days.sort(key=lambda item: Report_Generate.day_sort_key(item[0]))
+    for name, day in days:
+        yield parts + (name,), day
+    del days
+    for name, children in folders:
+        if children is None:
+            yield from buckets()
+        else:
+            yield from serial_walk_days(children, parts + (name,))
+
+
+# Runs the report once with the serial walk_days swapped in
+def run_serial():
+    walk_days = Report_Generate.walk_days
+    Report_Generate.walk_days = serial_walk_days
+    try:
+        return run(1)
+    finally:
+        Report_Generate.walk_days = walk_days
+
+
+def run(workers):
+    args = argparse.Namespace(dest="P", md=True, json=True, json_format="pretty", workers=workers, full_rescan=True)
+    started = time.perf_counter()
+    Report_Generate.create_report(args)
+    elapsed = time.perf_counter() - started
+    reports = Path("P") / "reports"
+    return elapsed, (reports / "report.md").read_bytes() + (reports / "manifest.json").read_bytes()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serial vs parallel report scan on a synthetic bucket tree")
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--files-per-day", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16])
+    bench_args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix="daybuckets-bench-")
+    os.chdir(workdir)
+    try:
+        build_tree(Path("P"), bench_args.years, bench_args.files_per_day)
+        if bench_args.latency_ms:
+            add_latency(bench_args.latency_ms / 1000)
+        days = bench_args.years * 12 * 28
+        print(f"{days} days, {days * bench_args.files_per_day} files, {bench_args.latency_ms}ms per listing/stat")
+        serial, expected = run_serial()
+        print(f"serial    : {serial:.2f}s (walk_days before --workers)")
+        for workers in bench_args.workers:
+            elapsed, output = run(workers)
+            print(f"workers {workers:<2}: {elapsed:.2f}s ({serial / elapsed:.1f}x){'' if output == expected else ' OUTPUT DIFFERS'}")
+    finally:
+        os.chdir("/")
+        shutil.rmtree(workdir)
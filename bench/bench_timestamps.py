@@ -0,0 +1,73 @@
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from dateutil import parser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # The pipeline modules live in the repo root
+import Download_Files
+from Download_Files import parse_fallback_datetime
+
+# DateTimeOriginal / upload timestamp values as they come back from the Commons imageinfo API
+CORPUS = [
+    "2014-06-14 10:25:33",
+    "2011:08:21 16:42:10",
+    "2019-03-02T17:41:05Z",
+    "2009-03-12",
+    "2016-07-20 12:44:08 (UTC)",
+    "2013-05-01 09:12",
+    "Taken on 12 March 2009",
+    "before 1900",
+    "circa 1890",
+    "1 January 1950",
+    "March 2007",
+    "<time class=\"dtstart\" datetime=\"1925\">1925</time>",
+    "<time class=\"dtstart\" datetime=\"2008-08-30\">30 August 2008</time>",
+    "2015-02-01&nbsp;(from EXIF)",
+    "2012:12:24 00:00:00",
+    "1930s",
+    "2018-11-04T08:15:00+01:00",
+    "2010\xa0-\xa006\xa0-\xa019",
+]
+ROUNDS = 2000
+
+
+# The parser as it was before the fast path and memo: five regex passes and a fuzzy dateutil parse every call
+def legacy_parse(raw_mtime):
+    raw_mtime = re.sub(r"<.*?>", "", raw_mtime)
+    raw_mtime = raw_mtime.replace("\xa0", " ").strip()
+    raw_mtime = re.sub(r"^Taken on\s*", "", raw_mtime, flags=re.I)
+    raw_mtime = re.sub(r"^before\s*", "", raw_mtime, flags=re.I)
+    raw_mtime = re.sub(r"\(UTC\)|\(from.*\)", "", raw_mtime, flags=re.I).strip()
+    try:
+        return parser.parse(raw_mtime, fuzzy=True)
+    except Exception:
+        pass
+    match = re.search(r"\b(\d{4})\b", raw_mtime)
+    if match:
+        return datetime(int(match.group(1)), 1, 1)
+    return datetime.fromtimestamp(time.time())
+
+
+def timed(func):
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        for value in CORPUS:
+            func(value)
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    calls = ROUNDS * len(CORPUS)
+    legacy = timed(legacy_parse)
+    Download_Files._parse_fuzzy.cache_clear()
+    current = timed(parse_fallback_datetime)
+    print(f"{calls} parses over {len(CORPUS)} Commons date strings")
+    print(f"legacy : {legacy:.3f}s ({legacy / calls * 1e6:.1f}us per call)")
+    print(f"current: {current:.3f}s ({current / calls * 1e6:.1f}us per call), {legacy / current:.1f}x faster")
+    print(f"fuzzy memo: {Download_Files._parse_fuzzy.cache_info()}")
+    for value in CORPUS: # Shows where the two parsers disagree (mostly EXIF dates dateutil reads as a time of day)
+        old, new = legacy_parse(value), parse_fallback_datetime(value)
+        if old != new:
+            print(f"  {value!r}: legacy {old} -> current {new}")
@@ -0,0 +1,223 @@
+import re
+import sys
+import json
+import gzip
+import hashlib
+import socket
+import math
+import argparse
+import threading
+import urllib.parse
+import http.server
+from collections import Counter
+
+# Local stand-in for the Commons API and upload server, for benchmarking the pipeline offline.
+# Answers list=categorymembers (cmcontinue paging), generator=categorymembers&prop=imageinfo (gcmcontinue paging and
+# iicontinue for large batches) and pageids=...&prop=imageinfo in the same JSON shapes as the real API, and serves
+# synthetic image payloads at /file/<pageid> (Range requests get a 206 slice, or a 416 past the end). Category Bench_0 is the root: categories nest as a binary tree and
+# every leaf links back to the root, so the crawl has to cope with cycles. Every --missing-every'th file is a
+# missing page. --throttle-every and --maxlag-every answer every Nth API request with a 429 (and Retry-After) or a
+# maxlag error instead, to exercise the client's backoff. --drop-every cuts every Nth file transfer off halfway
+# through, so the client has to resume it from its .part file. GET /stats returns the request counts
+ROOT = "Bench_0"
+
+
+class SyntheticCommons:
+    def __init__(self, files, per_category, min_size, max_size, missing_every, page_limit, ii_batch, throttle_every=0, maxlag_every=0, drop_every=0):
+        self.files = files
+        self.per_category = per_category
+        self.categories = max(1, math.ceil(files / per_category))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.missing_every = missing_every
+        self.page_limit = page_limit
+        self.ii_batch = ii_batch
+        self.throttle_every = throttle_every
+        self.maxlag_every = maxlag_every
+        self.drop_every = drop_every
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+            return self.counts[name]
+
+    # Members of a category: its own files, then its two child categories (or the root, for leaves)
+    def members(self, name):
+        try:
+            index = int(name.rsplit("_", 1)[1])
+        except (IndexError, ValueError):
+            return []
+        if not name.startswith("Bench_") or index >= self.categories:
+            return []
+        first = index * self.per_category + 1
+        members = [{"pageid": pageid, "ns": 6, "title": f"File:Bench_{pageid}.jpg"}
+                   for pageid in range(first, min(first + self.per_category, self.files + 1))]
+        children = [child for child in (2 * index + 1, 2 * index + 2) if child < self.categories] or [0]
+        members += [{"pageid": 10**9 + child, "ns": 14, "title": f"Category:Bench_{child}"} for child in children]
+        return members
+
+    def size(self, pageid):
+        return self.min_size + (pageid * 2654435761) % (self.max_size - self.min_size + 1)
+
+    def payload(self, pageid):
+        return bytes([pageid % 251]) * self.size(pageid)
+
+    def missing(self, pageid):
+        return self.missing_every and pageid % self.missing_every == 0
+
+    # imageinfo of one file, with a capture date spread over a few years so organize fills many day buckets
+    def imageinfo(self, pageid, host):
+        day = pageid % 1500
+        year, day_of_year = 2018 + day // 365, day % 365
+        month, day_of_month = 1 + day_of_year // 31 % 12, 1 + day_of_year % 28
+        return [{
+            "timestamp": f"{year}-{month:02d}-{day_of_month:02d}T12:00:00Z",
+            "user": "Bench",
+            "url": f"http://{host}/file/{pageid}",
+            "size": self.size(pageid),
+            "sha1": hashlib.sha1(self.payload(pageid)).hexdigest(), # Checked by the client after each download
+            "mediatype": "BITMAP",
+            "extmetadata": {
+                "DateTimeOriginal": {"value": f"{year}:{month:02d}:{day_of_month:02d} {pageid % 24:02d}:00:00"},
+                "Artist": {"value": "Bench"},
+                "LicenseShortName": {"value": "CC BY-SA 4.0"},
+            },
+        }]
+
+    def page(self, member, host, with_imageinfo=True):
+        page = dict(member)
+        if member["ns"] == 6 and self.missing(member["pageid"]):
+            page["missing"] = ""
+        elif member["ns"] == 6 and with_imageinfo:
+            page["imageinfo"] = self.imageinfo(member["pageid"], host)
+        return page
+
+    def query(self, params, host):
+        if params.get("list") == "categorymembers" or params.get("generator") == "categorymembers":
+            prefix = "gcm" if params.get("generator") else "cm"
+            members = self.members(params.get(f"{prefix}title", "").split(":", 1)[-1])
+            start = int(params.get(f"{prefix}continue", 0) or 0)
+            limit = min(int(params.get(f"{prefix}limit", self.page_limit)), self.page_limit)
+            chunk = members[start:start + limit]
+            result = {}
+            continue_params = {}
+            if start + limit < len(members):
+                continue_params = {f"{prefix}continue": str(start + limit), "continue": "-||" if prefix == "cm" else "gcmcontinue||"}
+            if prefix == "cm":
+                result["query"] = {"categorymembers": chunk}
+                if continue_params:
+                    result["continue"] = continue_params
+                return result
+            ii_start = int(params.get("iicontinue", 0) or 0) # Real batches are split when the imageinfo gets too large
+            pages = {str(m["pageid"]): self.page(m, host, ii_start <= n < ii_start + self.ii_batch) for n, m in enumerate(chunk)}
+            if ii_start + self.ii_batch < len(chunk):
+                result["continue"] = {"iicontinue": str(ii_start + self.ii_batch), "continue": "gcmcontinue||"}
+                if start:
+                    result["continue"]["gcmcontinue"] = str(start)
+            else:
+                result["batchcomplete"] = ""
+                if continue_params:
+                    result["continue"] = continue_params
+            result["query"] = {"pages": pages}
+            return result
+        if params.get("pageids"):
+            pages = {}
+            for pageid in params["pageids"].split("|"):
+                pageid = int(pageid)
+                pages[str(pageid)] = self.page({"pageid": pageid, "ns": 6, "title": f"File:Bench_{pageid}.jpg"}, host)
+            return {"batchcomplete": "", "query": {"pages": pages}}
+        return {"error": {"code": "badparams", "info": f"Unsupported query {params}"}}
+
+
+def make_handler(commons):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Keep-alive, like the real servers
+
+        def setup(self):
+            super().setup()
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Headers and body go out as separate writes
+
+        def log_message(self, *args):
+            pass
+
+        # cut sends only the first half of the body after a full Content-Length, then closes the connection
+        def send(self, code, body, content_type="application/json", headers=None, cut=False):
+            self.send_response(code)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if content_type == "application/json" and "gzip" in self.headers.get("Accept-Encoding", ""):
+                body = gzip.compress(body, compresslevel=1)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if cut:
+                self.wfile.write(body[:len(body) // 2])
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+        # A file payload, honouring a "bytes=start-[end]" Range header
+        def send_file(self, pageid):
+            n = commons.count("files")
+            cut = bool(commons.drop_every and n % commons.drop_every == 0)
+            if cut:
+                commons.count("dropped")
+            body = commons.payload(pageid)
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", "").strip())
+            if not match:
+                return self.send(200, body, "image/jpeg", cut=cut)
+            commons.count("ranged")
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(body) - 1, len(body) - 1)
+            if start >= len(body):
+                return self.send(416, b"", "text/plain", {"Content-Range": f"bytes */{len(body)}"})
+            return self.send(206, body[start:end + 1], "image/jpeg", {"Content-Range": f"bytes {start}-{end}/{len(body)}"}, cut=cut)
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path.startswith("/file/"):
+                return self.send_file(int(url.path.rsplit("/", 1)[1]))
+            if url.path == "/stats":
+                with commons.lock:
+                    return self.send(200, json.dumps(commons.counts).encode())
+            n = commons.count("api")
+            if commons.throttle_every and n % commons.throttle_every == 0:
+                commons.count("throttled")
+                return self.send(429, b"Too many requests", "text/plain", {"Retry-After": "1"})
+            if commons.maxlag_every and n % commons.maxlag_every == 0:
+                commons.count("maxlag")
+                error = {"error": {"code": "maxlag", "info": "Waiting for a database server: 6 seconds lagged.", "lag": 6}}
+                return self.send(200, json.dumps(error).encode(), headers={"Retry-After": "1", "X-Database-Lag": "6"})
+            params = dict(urllib.parse.parse_qsl(url.query))
+            self.send(200, json.dumps(commons.query(params, self.headers.get("Host"))).encode())
+
+    return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the Commons API and file server")
+    parser.add_argument("--port", type=int, default=8780)
+    parser.add_argument("--files", type=int, default=1000, help="Files in the whole category tree")
+    parser.add_argument("--per-category", type=int, default=250, help="Files directly in each category")
+    parser.add_argument("--min-size", type=int, default=512, help="Smallest image payload in bytes")
+    parser.add_argument("--max-size", type=int, default=4096, help="Largest image payload in bytes")
+    parser.add_argument("--missing-every", type=int, default=97, help="Every Nth file is a missing page (0 for none)")
+    parser.add_argument("--page-limit", type=int, default=500, help="Max members per categorymembers page")
+    parser.add_argument("--ii-batch", type=int, default=50, help="Pages that get imageinfo per generator response before iicontinue")
+    parser.add_argument("--throttle-every", type=int, default=0, help="Answer every Nth API request with 429 Too Many Requests (0 for never)")
+    parser.add_argument("--maxlag-every", type=int, default=0, help="Answer every Nth API request with a maxlag error (0 for never)")
+    parser.add_argument("--drop-every", type=int, default=0, help="Cut every Nth file transfer off halfway through (0 for never)")
+    args = parser.parse_args(argv)
+    commons = SyntheticCommons(args.files, args.per_category, args.min_size, args.max_size, args.missing_every, args.page_limit, args.ii_batch,
+                               args.throttle_every, args.maxlag_every, args.drop_every)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(commons))
+    server.daemon_threads = True
+    print(f"Serving {args.files} files in {commons.categories} categories on http://127.0.0.1:{args.port}/w/api.php", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,15 +2,27 @@ import os
 import sys
 import logging
 import argparse
+import cProfile
 from pathlib import Path
-from Logging_Funct import setup_logging
-from Fetch_Category_Members import get_all_category_members
-from Download_Files import save_files_and_data
+from Logging_Funct import setup_logging, LOG_FORMATS
+from Fetch_Category_Members import iter_category_members, ListingError, FETCH_PATHS
+from Download_Files import download_all
+from Rate_Limiter import configure_rate, limiter_stats
+import Http_Client
+from Http_Client import log_stats
+import Metrics
+import Fetch_Category_Members
+from Download_Index import open_index, close_index
+import Crawl_Journal
+from Metadata_Store import configure_store, STORE_FORMATS
+from Response_Cache import configure_cache, log_cache_stats, DEFAULT_TTL_HOURS, DEFAULT_MAX_MB
 from Sort_Files import file_to_sort
-from Report_Generate import create_report, files_for_report_count
+import Report_Generate
+from Watch_Incoming import watch_incoming, SETTLE_SECONDS
+from Report_Generate import create_report
 
-# Function that begins the call for all the other functions based on the CLI arguments passed 
-def args_command(args):
+# Function that clears old logs if requested and starts logging for any of the commands
+def start_logging(args):
     if args.clearLog: # Clears the log files if the user passes the --clearlog modifier
         if args.dest is None: # Sets the default location to check for an existing log if no location is provided
             folder = f"PROJECT/logs/"
@@ -24,24 +36,113 @@ def args_command(args):
             for logfile in Path(log_dir).iterdir(): # Iterates through all the log files in the logs directory and deletes them in case there are multiple log files
                 os.remove(logfile)
         logging.info(f"removed pre-existing log file(s)")
-    logfile = setup_logging(args,) # Calls the function that starts appending to the log file
+    return setup_logging(args,) # Calls the function that starts appending to the log file
+
+# Function that begins the call for all the other functions based on the CLI arguments passed 
+def args_command(args):
+    logfile = start_logging(args)
+    resume = None
+    if not args.dry_run: # The crawl journal in <dest>/state/ lets `fetch --resume` carry on after an interrupted run
+        params = {"category": args.category, "limit": args.limit, "max_depth": args.max_depth, "fetch_path": args.fetch_path, "full_metadata": args.full_metadata}
+        resume = Crawl_Journal.open_journal(args.dest, params, resume=args.resume)
+        if resume: # The crawl carries on with the parameters it was started with
+            for name, value in resume["params"].items():
+                setattr(args, name, value)
+        elif not args.category:
+            logging.error(f"No unfinished crawl to resume in {args.dest} and no --category given, nothing to fetch")
+            return
+    elif args.resume:
+        logging.warning(f"--resume is ignored with --dry-run")
     logging.info(f"Fetching category '{args.category}' into {args.dest}") # Starts the logging by saying what category is being fetched
-    # Calls the function that grabs the different files within the requested category
-    files = get_all_category_members(_seen=None,category=args.category, limit=args.limit) 
+    # Calls the generator that streams the different files within the requested category
+    # One limiter shared by category listing, metadata and downloads. Listing and download pools each have --workers
+    # threads, so up to twice that many requests may be in flight once the API has shown it keeps up
+    configure_rate(args.rate, max_concurrency=2 * max(1, args.workers), burst=args.burst)
+    open_index(args.dest) # pageid -> sha1/location index that lets re-runs skip unchanged files
+    configure_store(args.metadata_store)
+    configure_cache(args.dest, enabled=not args.no_cache, refresh=args.refresh, ttl_hours=args.cache_ttl, max_mb=args.cache_max_mb)
+    files = iter_category_members(category=args.category, limit=args.limit, _seen=None, max_depth=args.max_depth, workers=args.workers, fetch_path=args.fetch_path,
+                                  metadata_profile="full" if args.full_metadata else "lean", resume=resume)
+    # Downloads the file and meta data of each file as soon as it is listed, over a bounded pool of workers
+    finished = False
+    try:
+        with Metrics.stage("fetch"): # Listing, metadata and downloads overlap, so they are timed as one stage
+            summary = download_all(files, args.dest, args.dry_run, workers=args.workers)
+        finished = True
+    except ListingError as e: # Downloads of the files already listed have finished, the rest of the crawl is owed
+        logging.error(f"{e}. The crawl stopped early, `fetch --resume` carries on from that page")
+        sys.exit(1)
+    finally:
+        Crawl_Journal.close_journal(finished)
     # Tells how many files were found and logged from the requested category after they are fetched
-    logging.info(f"Found {len(files)} files in category {args.category}")
-    # Downloads the file and meta data of each file retrieved from the category by calling the downloading function
-    for f in files:
-        save_files_and_data(f, args.dest, args.dry_run)
-    logging.info(f"saved image and metadata for {len(files)} files in category {args.category}")
+    logging.info(f"Found {summary['total']} files in category {args.category}")
+    logging.info(f"saved image and metadata for {summary['downloaded'] + summary['skipped']} ({summary['unchanged']} unchanged) of {summary['total']} files in category {args.category}")
+    log_stats() # Per-host request counts, bytes and latency for the fetch stage
+    log_cache_stats()
     # Calls the file moving and sorting function if requested in the CLI command provided
     if args.mode: 
-        file_to_sort(args)
-        logging.info(f"{args.mode} performed on {len(files)} total files")
+        with Metrics.stage("sort"):
+            file_to_sort(args)
+        logging.info(f"{args.mode} performed on {summary['total']} total files")
+    close_index()
     # Calls the report generating function if requested
     if args.md or args.json:
+        run_report(args)
+
+# Function to create the requested reports, timed as the "report" stage of the run metrics
+def run_report(args):
+    before = Report_Generate.files_for_report_count
+    with Metrics.stage("report"):
         create_report(args)
-        logging.info(f"data to collect from {files_for_report_count} total files for report generation")
+    Metrics.add_files("report", Report_Generate.files_for_report_count - before)
+    logging.info(f"data to collect from {Report_Generate.files_for_report_count} total files for report generation")
+
+# Function to run the chosen command, with --profile under cProfile, then save the run metrics
+def run_command(args):
+    Metrics.reset()
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler:
+            profiler.runcall(args.func, args)
+        else:
+            args.func(args)
+    finally:
+        if profiler:
+            profile_path = Path(args.dest) / "reports" / "profile.pstats"
+            profile_path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(profile_path) # Read it with: python -m pstats <dest>/reports/profile.pstats
+            logging.info(f"cProfile dump saved to {profile_path}")
+        Metrics.write_metrics(args.dest, {
+            "command": args.command,
+            "api_calls": dict(Fetch_Category_Members.api_calls),
+            "http": Http_Client.stats,
+            "limiter": limiter_stats(),
+        })
+
+# Function for the organize command: sorts what is already in incoming/ and optionally reports, without any network activity
+def organize_command(args):
+    logfile = start_logging(args)
+    if args.mode and args.watch: # Runs until Ctrl-C, refreshing the (incremental) reports after every batch
+        with Metrics.stage("sort"):
+            watch_incoming(args, on_batch=(lambda: run_report(args)) if args.md or args.json else None)
+        close_index()
+        return
+    if args.mode:
+        with Metrics.stage("sort"):
+            file_to_sort(args)
+    else:
+        logging.warning(f"No --mode passed, nothing to organize")
+    close_index()
+    if args.md or args.json:
+        run_report(args)
+
+# Function for the report command: builds the requested reports from what is already on disk
+def report_command(args):
+    logfile = start_logging(args)
+    if not (args.md or args.json):
+        logging.warning(f"Neither --md nor --json passed, no report to create")
+        return
+    run_report(args)
 
 # The main function with the different argparse commands
 def main():
@@ -49,17 +150,33 @@ def main():
     subparsers = parser.add_subparsers(dest="command")
     # Delineates the different CLI modifiers that can be passed and gives a helpful tip for what they do below is for fetching
     fetch_parser = subparsers.add_parser("fetch", help="Fetch files from Wikimedia Commons by category")
-    fetch_parser.add_argument("--category", required=True, help="Category name (e.g., 'Cathedrals')")
+    fetch_parser.add_argument("--category", help="Category name (e.g., 'Cathedrals'). Required unless --resume is passed")
     fetch_parser.add_argument("--dest", default="PROJECT", help="Destination folder")
     fetch_parser.add_argument("--limit", type=int, default=None, help="Max number of files to fetch")
     fetch_parser.add_argument("--dry-run", action="store_true", help="Do everything except download")
     fetch_parser.add_argument("--verbose", action="store_true", help="Log prints to terminal and saves to log file")
-    fetch_parser.add_argument("--mode", choices=["move","copy"], help="Optional argument. Would you like to 'copy' or 'move' the data")
+    fetch_parser.add_argument("--mode", choices=["move","copy","hardlink","reflink"], help="Optional argument. Would you like to 'copy' or 'move' the data, or 'hardlink'/'reflink' it into the buckets without copying bytes (falls back to copy)")
     fetch_parser.add_argument("--debug", action="store_true", help="Enable DEBUG logging to help program debugging")
+    fetch_parser.add_argument("--log-files", action="store_true", help="Also log one line per file handled (FILE level), without the full DEBUG output")
+    fetch_parser.add_argument("--profile", action="store_true", help="Run under cProfile and save the stats to <dest>/reports/profile.pstats")
+    fetch_parser.add_argument("--log-format", choices=LOG_FORMATS, default="text", help="'json' writes the log file as JSON lines (time, level, thread, module, message)")
     fetch_parser.add_argument("--clearLog", action="store_true", help="Set to clear the log manually, or let the log files clear weekly")
-    fetch_parser.add_argument("--moveType", choices=["keepboth","keepnew","keepold"], help="Would you like to 'keepboth' files, only 'keepnew' file, or 'keepold' file and delete the new file")
+    fetch_parser.add_argument("--moveType", choices=["keepboth","keepnew","keepold","dedupe","dedupelink"], help="Would you like to 'keepboth' files, only 'keepnew' file, or 'keepold' file and delete the new file. 'dedupe' skips files whose bytes are already in the bucket, 'dedupelink' hardlinks them instead")
     fetch_parser.add_argument("--md", action="store_true", help="Creates a human-readable markdown file report")
     fetch_parser.add_argument("--json", action="store_true", help="Creates a machine-readable .json file report")
+    fetch_parser.add_argument("--json-format", choices=["pretty","compact","ndjson"], default="pretty", help="Indented manifest.json, the same without whitespace, or manifest.ndjson with one day per line")
+    fetch_parser.add_argument("--workers", type=int, default=1, help="Number of files to download (and subcategories to list) at the same time")
+    fetch_parser.add_argument("--fetch-path", choices=FETCH_PATHS, default="generator", help="'generator' gets members and metadata in one query per page, 'twostep' lists members then fetches metadata in batches of 50")
+    fetch_parser.add_argument("--full-metadata", action="store_true", help="Request every extmetadata field instead of only the capture date and attribution fields")
+    fetch_parser.add_argument("--no-cache", action="store_true", help="Always query the API instead of using the imageinfo cache in <dest>/cache/")
+    fetch_parser.add_argument("--refresh", action="store_true", help="Treat every cached imageinfo answer as expired and fetch it again")
+    fetch_parser.add_argument("--cache-ttl", type=float, default=DEFAULT_TTL_HOURS, help="Hours a file's cached imageinfo stays fresh (a new version uploaded meanwhile is only seen after that). Category listings are never cached")
+    fetch_parser.add_argument("--cache-max-mb", type=float, default=DEFAULT_MAX_MB, help="Size cap of the imageinfo cache, least recently used entries are evicted above it")
+    fetch_parser.add_argument("--max-depth", type=int, default=None, help="How many levels of subcategories to descend into (0 for only the given category)")
+    fetch_parser.add_argument("--rate", type=float, default=10.0, help="Max requests per second across all workers (0 for no limit)")
+    fetch_parser.add_argument("--metadata-store", choices=STORE_FORMATS, default="sidecar", help="'sidecar' writes a .meta.json next to every image, 'jsonl' one _metadata.jsonl record per image in its folder (organize moves the records with the images)")
+    fetch_parser.add_argument("--resume", action="store_true", help="Carry on with the interrupted crawl recorded in <dest>/state/ (same category, limit and depth) without repeating its API calls")
+    fetch_parser.add_argument("--burst", type=float, default=None, help="Requests that may go back to back after a quiet spell, without exceeding --rate on average (default a quarter of --rate)")
 
     fetch_parser.set_defaults(func=args_command) # The first argument passed should be 'fetch' for fetching the files - then runs the arg command
 
@@ -67,22 +184,39 @@ def main():
     organize_parser = subparsers.add_parser("organize", help="Organize existing files")
     organize_parser.add_argument("--verbose", action="store_true", help="Log prints to terminal and saves to log file")
     organize_parser.add_argument("--debug", action="store_true", help="Enable DEBUG logging to help program debugging")
+    organize_parser.add_argument("--log-files", action="store_true", help="Also log one line per file handled (FILE level), without the full DEBUG output")
+    organize_parser.add_argument("--profile", action="store_true", help="Run under cProfile and save the stats to <dest>/reports/profile.pstats")
+    organize_parser.add_argument("--log-format", choices=LOG_FORMATS, default="text", help="'json' writes the log file as JSON lines (time, level, thread, module, message)")
     organize_parser.add_argument("--clearLog", action="store_true", help="Set to clear the log manually, or let the log files clear weekly")
-    organize_parser.add_argument("--mode", choices=["move","copy"], help="Optional argument. Would you like to 'copy' or 'move' the data")
-    organize_parser.add_argument("--moveType", choices=["keepboth","keepnew","keepold"], help="Would you like to 'keepboth' files, only 'keepnew' file, or 'keepold' file and delete the new file")
+    organize_parser.add_argument("--mode", choices=["move","copy","hardlink","reflink"], help="Optional argument. Would you like to 'copy' or 'move' the data, or 'hardlink'/'reflink' it into the buckets without copying bytes (falls back to copy)")
+    organize_parser.add_argument("--moveType", choices=["keepboth","keepnew","keepold","dedupe","dedupelink"], help="Would you like to 'keepboth' files, only 'keepnew' file, or 'keepold' file and delete the new file. 'dedupe' skips files whose bytes are already in the bucket, 'dedupelink' hardlinks them instead")
     organize_parser.add_argument("--dest", default="PROJECT", help="Destination folder")
     organize_parser.add_argument("--md", action="store_true", help="Creates a human-readable markdown file report")
     organize_parser.add_argument("--json", action="store_true", help="Creates a machine-readable .json file report")
+    organize_parser.add_argument("--json-format", choices=["pretty","compact","ndjson"], default="pretty", help="Indented manifest.json, the same without whitespace, or manifest.ndjson with one day per line")
+    organize_parser.add_argument("--workers", type=int, default=1, help="Number of day buckets to sort at the same time")
+    organize_parser.add_argument("--watch", action="store_true", help="Keep running and sort every image and metadata pair as soon as both have landed in incoming/ (Ctrl-C to stop)")
+    organize_parser.add_argument("--settle", type=float, default=SETTLE_SECONDS, help="Seconds a new pair must stay unchanged before --watch sorts it")
+    organize_parser.add_argument("--poll", action="store_true", help="Make --watch list incoming/ on a timer instead of using inotify (for network storage)")
+    organize_parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between listings when --watch polls")
+    organize_parser.set_defaults(func=organize_command)
     # A new parser subclass for creating reports without fetching
 
 
-    report_parser = subparsers.add_parser("report", help="Organize existing files")
+    report_parser = subparsers.add_parser("report", help="Create reports for existing files")
     report_parser.add_argument("--verbose", action="store_true", help="Log prints to terminal and saves to log file")
     report_parser.add_argument("--debug", action="store_true", help="Enable DEBUG logging to help program debugging")
+    report_parser.add_argument("--log-files", action="store_true", help="Also log one line per file handled (FILE level), without the full DEBUG output")
+    report_parser.add_argument("--profile", action="store_true", help="Run under cProfile and save the stats to <dest>/reports/profile.pstats")
+    report_parser.add_argument("--log-format", choices=LOG_FORMATS, default="text", help="'json' writes the log file as JSON lines (time, level, thread, module, message)")
     report_parser.add_argument("--clearLog", action="store_true", help="Set to clear the log manually, or let the log files clear weekly")
     report_parser.add_argument("--dest", default="PROJECT", help="Destination folder")
     report_parser.add_argument("--md", action="store_true", help="Creates a human-readable markdown file report")
     report_parser.add_argument("--json", action="store_true", help="Creates a machine-readable .json file report")
+    report_parser.add_argument("--json-format", choices=["pretty","compact","ndjson"], default="pretty", help="Indented manifest.json, the same without whitespace, or manifest.ndjson with one day per line")
+    report_parser.add_argument("--workers", type=int, default=1, help="Number of folders to scan at the same time (helps most on network storage)")
+    report_parser.add_argument("--full-rescan", action="store_true", help="Walk the whole bucket tree and check the report index against it instead of rescanning only changed days")
+    report_parser.set_defaults(func=report_command)
 
     # Sets the args variable to the parser class so it can be used throughout the other code files and have the attributes defined above
     args = parser.parse_args()
@@ -90,8 +224,10 @@ def main():
         parser.print_help()
         logging.critical(f"Argument not passed, program closed. {parser}")
         sys.exit(1)
+    if args.command == "fetch" and not args.category and not args.resume:
+        fetch_parser.error("--category is required unless --resume is passed")
 
-    args.func(args)
+    run_command(args)
 
 
     